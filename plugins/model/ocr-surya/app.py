@@ -1,17 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import asyncio
 import base64
+import hashlib
 import io
 import json
 import logging
 import os
-from typing import List, Optional
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Literal, Optional, Tuple, Union
 
+import numpy as np
 import torch
 import uvicorn
-from fastapi import FastAPI, HTTPException, Security
+from fastapi import FastAPI, File, Form, HTTPException, Request, Security, UploadFile
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from PIL import Image, ImageFile
+from PIL import Image
 from pydantic import BaseModel
 from surya.model.detection.model import load_model as load_det_model
 from surya.model.detection.model import load_processor as load_det_processor
@@ -25,6 +34,33 @@ app = FastAPI()
 security = HTTPBearer()
 env_bearer_token = None
 
+# 显存占用（reserved / total）超过该比例时才回收缓存
+GC_MEMORY_FRACTION = float(os.getenv("GC_MEMORY_FRACTION", 0.8))
+# 图片解码线程数
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", min(8, os.cpu_count() or 1)))
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+# 跨请求合并时单批最多的图片数
+OCR_MAX_BATCH_IMAGES = int(os.getenv("OCR_MAX_BATCH_IMAGES", 32))
+# 凑批的最长等待时间（毫秒），交互请求和批量导入请求分别配置
+OCR_INTERACTIVE_WAIT_MS = float(os.getenv("OCR_INTERACTIVE_WAIT_MS", 10))
+OCR_BULK_WAIT_MS = float(os.getenv("OCR_BULK_WAIT_MS", 200))
+LANGS = json.loads(os.getenv("LANGS", '["zh", "en"]'))
+# 结果缓存：内存中最多缓存的图片数，0 表示关闭；磁盘缓存目录为空时不启用磁盘缓存
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", 1024))
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "")
+OCR_CACHE_DISK_MB = float(os.getenv("OCR_CACHE_DISK_MB", 1024))
+# JPEG 长边超过 OCR_DRAFT_THRESHOLD 时用 Pillow draft 模式在解码时直接缩小（按 1/2、1/4、1/8 缩放），
+# 缩小后长边不小于 OCR_DRAFT_MAX_SIDE、短边不小于 OCR_TILE_SIZE，0 表示不缩小；缩小后仍可能再分块，
+# 返回的 bbox 始终换算回原图坐标
+OCR_DRAFT_THRESHOLD = int(os.getenv("OCR_DRAFT_THRESHOLD", 8192))
+OCR_DRAFT_MAX_SIDE = int(os.getenv("OCR_DRAFT_MAX_SIDE", 4096))
+# 长边超过 OCR_TILE_THRESHOLD 的图片切成 OCR_TILE_SIZE 大小、相互重叠 OCR_TILE_OVERLAP 像素的分块分别识别，0 表示不分块
+OCR_TILE_THRESHOLD = int(os.getenv("OCR_TILE_THRESHOLD", 4096))
+OCR_TILE_SIZE = int(os.getenv("OCR_TILE_SIZE", 2048))
+OCR_TILE_OVERLAP = int(os.getenv("OCR_TILE_OVERLAP", 128))
+# /v1/ocr/raw 请求体超过该大小（MB）时暂存到磁盘
+OCR_SPOOL_MAX_MB = int(os.getenv("OCR_SPOOL_MAX_MB", 16))
+
 
 # GPU显存回收
 def torch_gc():
@@ -33,9 +69,22 @@ def torch_gc():
         torch.cuda.ipc_collect()  # 收集CUDA内存碎片
 
 
+# 只在显存占用超过阈值时回收，避免每张图片都清空缓存导致后续批次重新申请显存
+def torch_gc_if_needed():
+    if not torch.cuda.is_available():
+        return
+    total = torch.cuda.get_device_properties(0).total_memory
+    if torch.cuda.memory_reserved() >= total * GC_MEMORY_FRACTION:
+        torch_gc()
+
+
 class ImageReq(BaseModel):
     images: List[str]
     sorted: Optional[bool] = False
+    # interactive：用户在线等待的请求，优先进入批次；bulk：数据集导入等批量请求，可以多等一会凑更大的批
+    priority: Literal["interactive", "bulk"] = "interactive"
+    # 为 true 时额外返回每张图片的文本行及其 bbox（[x1, y1, x2, y2]）和置信度
+    return_lines: Optional[bool] = False
 
 
 class Singleton(type):
@@ -49,7 +98,7 @@ class Singleton(type):
 class Surya(metaclass=Singleton):
 
     def __init__(self):
-        self.langs = json.loads(os.getenv("LANGS", '["zh", "en"]'))
+        self.langs = LANGS
         self.batch_size = os.getenv("BATCH_SIZE")
         if self.batch_size is not None:
             self.batch_size = int(self.batch_size)
@@ -58,77 +107,588 @@ class Surya(metaclass=Singleton):
         self.rec_model, self.rec_processor = load_rec_model(
         ), load_rec_processor()
 
-    def run(self, image: ImageFile.ImageFile) -> List[OCRResult]:
-        predictions = run_ocr([image], [self.langs], self.det_model,
+    def run(self, images: List[Image.Image]) -> List[OCRResult]:
+        # 一次调用完成所有图片的检测和识别，由 run_ocr 按 BATCH_SIZE 分批
+        if len(images) == 0:
+            return []
+        predictions = run_ocr(images, [self.langs] * len(images), self.det_model,
                               self.det_processor, self.rec_model,
                               self.rec_processor, self.batch_size)
         return predictions
 
 
+class OcrScheduler(object):
+    """把并发请求的图片合并成批次交给 Surya.run。
+
+    两条队列：interactive 优先出队，bulk 只填充剩余位置。批次满 OCR_MAX_BATCH_IMAGES 张
+    或最早入队的图片达到所在队列的最长等待时间时立即执行；模型调用在单独的线程里串行执行，
+    不阻塞事件循环。
+    """
+
+    LANES = ("interactive", "bulk")
+
+    def __init__(self, max_batch: int = OCR_MAX_BATCH_IMAGES,
+                 max_wait_ms: dict = None):
+        self.max_batch = max(1, max_batch)
+        max_wait_ms = max_wait_ms or {"interactive": OCR_INTERACTIVE_WAIT_MS, "bulk": OCR_BULK_WAIT_MS}
+        self.max_wait = {lane: max_wait_ms[lane] / 1000 for lane in self.LANES}
+        self.lanes = {lane: deque() for lane in self.LANES}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._batches = 0
+        self._images = 0
+        self._queue_wait = 0.0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    def submit(self, images: List[Image.Image], priority: str = "interactive") -> List[asyncio.Future]:
+        # 每张图片一个 future，所在批次完成后即可取到结果
+        self._ensure_started()
+        futures = []
+        now = time.monotonic()
+        for image in images:
+            future = self._loop.create_future()
+            self.lanes[priority].append((image, future, now))
+            futures.append(future)
+        self._wakeup.set()
+        return futures
+
+    async def run(self, images: List[Image.Image], priority: str = "interactive") -> List[OCRResult]:
+        return list(await asyncio.gather(*self.submit(images, priority)))
+
+    def _deadline(self) -> Optional[float]:
+        deadlines = [lane[0][2] + self.max_wait[name] for name, lane in self.lanes.items() if lane]
+        return min(deadlines) if deadlines else None
+
+    def _pending(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def _take(self) -> list:
+        batch = []
+        for name in self.LANES:
+            lane = self.lanes[name]
+            while lane and len(batch) < self.max_batch:
+                batch.append(lane.popleft())
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # 凑批：直到图片数够一批或最早的图片到期
+            while self._pending() < self.max_batch:
+                deadline = self._deadline()
+                if deadline is None:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    self._wakeup.clear()
+                except asyncio.TimeoutError:
+                    break
+            batch = self._take()
+            if not batch:
+                continue
+            if self._pending():
+                self._wakeup.set()
+            started = time.monotonic()
+            self._batches += 1
+            self._images += len(batch)
+            self._queue_wait += sum(started - enqueued for _, _, enqueued in batch)
+            try:
+                results = await self._loop.run_in_executor(
+                    self.executor, Surya().run, [image for image, _, _ in batch])
+                torch_gc_if_needed()
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self._batches,
+            "images": self._images,
+            "avg_batch_size": self._images / self._batches if self._batches else 0.0,
+            "avg_queue_wait_ms": self._queue_wait / self._images * 1000 if self._images else 0.0,
+            "queue_depth": {name: len(lane) for name, lane in self.lanes.items()},
+        }
+
+
+ocr_scheduler = OcrScheduler()
+
+
+def model_version() -> str:
+    # 模型或 surya 版本变化后旧的缓存结果不再命中
+    version = os.getenv("OCR_MODEL_VERSION")
+    if version:
+        return version
+    try:
+        from importlib.metadata import version as package_version
+        return f"surya-ocr=={package_version('surya-ocr')}"
+    except Exception:
+        return "surya-ocr"
+
+
+class OcrCache(object):
+    """按图片内容哈希缓存识别出的文本行，内存 LRU + 可选的磁盘缓存。
+
+    key 为图片字节、LANGS 和模型版本的 SHA-256；内存未命中时查磁盘，磁盘命中后放回内存。
+    磁盘缓存每个结果一个 JSON 文件，总大小超过 OCR_CACHE_DISK_MB 时删除最久未使用的文件。
+    """
+
+    def __init__(self, max_size: int = OCR_CACHE_SIZE, disk_dir: str = OCR_CACHE_DIR,
+                 disk_mb: float = OCR_CACHE_DISK_MB, langs: List[str] = LANGS, version: str = None):
+        self.max_size = max_size
+        self.disk_dir = disk_dir
+        self.disk_limit = int(disk_mb * 1024 * 1024)
+        # draft 缩放和分块会影响识别结果，也作为 key 的一部分；末尾为结果格式版本（bbox 为原图坐标）
+        self.salt = json.dumps([langs, version or model_version(), OCR_DRAFT_THRESHOLD, OCR_DRAFT_MAX_SIDE,
+                                OCR_TILE_THRESHOLD, OCR_TILE_SIZE, OCR_TILE_OVERLAP, 2]).encode("utf-8")
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        if self.disk_dir:
+            self._load_disk_index()
+
+    def new_hash(self):
+        # 上传的图片分块读取时逐块更新哈希
+        return hashlib.sha256(self.salt + b"|")
+
+    def make_key(self, data: bytes) -> str:
+        hasher = self.new_hash()
+        hasher.update(data)
+        return hasher.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _load_disk_index(self):
+        # 启动时按修改时间恢复磁盘缓存的 LRU 顺序
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def get_many(self, keys: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self._memory_hits += 1
+                elif key in self._disk:
+                    lines = self._read_disk(key)
+                    if lines is None:
+                        self._misses += 1
+                        continue
+                    found[key] = lines
+                    self._disk_hits += 1
+                    self._put_memory(key, lines)
+                else:
+                    self._misses += 1
+        return found
+
+    def put_many(self, items: dict):
+        with self._lock:
+            for key, lines in items.items():
+                self._put_memory(key, lines)
+                if self.disk_dir:
+                    self._write_disk(key, lines)
+
+    def _put_memory(self, key: str, lines: list):
+        if self.max_size <= 0:
+            return
+        self._memory[key] = lines
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[list]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = json.load(f)
+            os.utime(path)
+            self._disk.move_to_end(key)
+            return lines
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取 OCR 磁盘缓存失败: {e}")
+            self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+
+    def _write_disk(self, key: str, lines: list):
+        if key in self._disk:
+            return
+        path = self._path(key)
+        data = json.dumps(lines, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.disk_limit:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"写入 OCR 磁盘缓存失败: {e}")
+            return
+        self._disk[key] = len(data)
+        self._disk_bytes += len(data)
+        while self._disk_bytes > self.disk_limit and self._disk:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        lookups = self._memory_hits + self._disk_hits + self._misses
+        return {
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "memory_hits": self._memory_hits,
+            "disk_hits": self._disk_hits,
+            "misses": self._misses,
+            "hit_rate": (self._memory_hits + self._disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+ocr_cache = OcrCache()
+
+
 class Chat(object):
 
-    def __init__(self):
-        self.surya = Surya()
+    def __init__(self, scheduler: OcrScheduler = ocr_scheduler, cache: OcrCache = ocr_cache):
+        self.scheduler = scheduler
+        self.cache = cache
 
-    def base64_to_image(base64_string: str) -> ImageFile.ImageFile:
+    @staticmethod
+    def open_image(source: Union[bytes, BinaryIO]) -> Tuple[Image.Image, Tuple[float, float]]:
+        """解码图片，返回 (RGB 图片, 原图与解码后图片的宽高之比)。
+
+        source 为图片字节或上传文件，上传文件直接从其缓冲区解码，不再复制一份。
+        """
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        size = image.size
+        if image.format == "JPEG" and 0 < OCR_DRAFT_THRESHOLD < max(size) and OCR_DRAFT_MAX_SIDE > 0:
+            # 短边也设下限，长截图不会因为长边超限被缩小而丢失小字
+            scale = max(OCR_DRAFT_MAX_SIDE / max(size), min(1.0, OCR_TILE_SIZE / min(size)))
+            image.draft("RGB", (int(image.width * scale), int(image.height * scale)))
+        # Image.open 只读取文件头，在解码线程里完成解码和 RGB 转换
+        image = image.convert("RGB")
+        return image, (size[0] / image.width, size[1] / image.height)
+
+    def load_image(self, base64_string: str) -> Optional[Tuple[str, bytes]]:
+        if not base64_string:
+            return None
         image_data = base64.b64decode(base64_string)
-        image_stream = io.BytesIO(image_data)
-        image = Image.open(image_stream)
-        return image
-
-    def sort_text_by_bbox(original_data: List[dict]) -> str:
-        # 根据bbox进行排序，从左到右，从上到下。返回排序后的按行的字符串。
-        # 排序
-        lines, line = [], []
-        original_data.sort(key=lambda item: item["bbox"][1])
-        for item in original_data:
-            mid_h = (item["bbox"][1] + item["bbox"][3]) / 2
-            if len(line) == 0 or (mid_h >= line[0]["bbox"][1]
-                                  and mid_h <= line[0]["bbox"][3]):
-                line.append(item)
-            else:
-                lines.append(line)
-                line = [item]
-        lines.append(line)
-        for line in lines:
-            line.sort(key=lambda item: item["bbox"][0])
-        # 构建行字符串
-        string_result = ""
-        for line in lines:
-            for item in line:
-                string_result += item["text"] + " "
-            string_result += "\n"
-        return string_result
-
-    def query_ocr(self, image_base64: str,
-                  sorted: bool) -> str:
-        if image_base64 is None or len(image_base64) == 0:
-            return ""
-        try:
-            image = Chat.base64_to_image(image_base64)
-            ocr_result = self.surya.run(image)
-            result = []
+        return self.cache.make_key(image_data), image_data
 
-            for text_line in ocr_result[0].text_lines:
-                result.append(text_line.text)
+    def load_file(self, file: BinaryIO, chunk_size: int = 1 << 20) -> Optional[Tuple[str, BinaryIO]]:
+        # 分块计算哈希，然后回到文件开头交给解码
+        hasher = self.cache.new_hash()
+        size = 0
+        file.seek(0)
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            hasher.update(chunk)
+            size += len(chunk)
+        if size == 0:
+            return None
+        file.seek(0)
+        return hasher.hexdigest(), file
 
-            if sorted:
-                result = self.sort_text_lines(result)
+    @staticmethod
+    def tile_positions(length: int) -> List[int]:
+        # 分块起点，最后一块与图片末端对齐，保证每块大小一致
+        if length <= OCR_TILE_SIZE:
+            return [0]
+        step = max(1, OCR_TILE_SIZE - OCR_TILE_OVERLAP)
+        return list(range(0, length - OCR_TILE_SIZE, step)) + [length - OCR_TILE_SIZE]
 
-            # 将所有文本行合并成一个字符串，用换行符分隔
-            final_result = "\n".join(result)
+    @staticmethod
+    def split_tiles(image: Image.Image) -> List[Tuple[Image.Image, Tuple[int, int]]]:
+        # 超大图片切成相互重叠的分块，返回 (分块, 分块左上角坐标)
+        if OCR_TILE_THRESHOLD <= 0 or max(image.size) <= OCR_TILE_THRESHOLD:
+            return [(image, (0, 0))]
+        return [(image.crop((x, y, min(x + OCR_TILE_SIZE, image.width), min(y + OCR_TILE_SIZE, image.height))), (x, y))
+                for y in Chat.tile_positions(image.height) for x in Chat.tile_positions(image.width)]
 
-            torch_gc()
-            return final_result
+    @staticmethod
+    def decode_tiles(source: Union[bytes, BinaryIO]) -> Tuple[List[Tuple[Image.Image, Tuple[int, int]]], Tuple[float, float]]:
+        image, scale = Chat.open_image(source)
+        return Chat.split_tiles(image), scale
+
+    @staticmethod
+    def scale_lines(lines: List[dict], scale: Tuple[float, float]) -> List[dict]:
+        # draft 缩小后识别的 bbox 换算回原图坐标
+        sx, sy = scale
+        if sx == 1 and sy == 1:
+            return lines
+        return [dict(line, bbox=[line["bbox"][0] * sx, line["bbox"][1] * sy, line["bbox"][2] * sx, line["bbox"][3] * sy])
+                for line in lines]
+
+    @staticmethod
+    def merge_tiles(tile_lines: List[List[dict]], offsets: List[Tuple[int, int]]) -> List[dict]:
+        # 把各分块的文本行平移回原图坐标，重叠区域中被两个分块都识别到的文本行只保留更完整（面积更大）的一个
+        if len(tile_lines) == 1:
+            return tile_lines[0]
+        lines, tiles = [], []
+        for tile, (part, (x, y)) in enumerate(zip(tile_lines, offsets)):
+            for line in part:
+                x1, y1, x2, y2 = line["bbox"]
+                lines.append(dict(line, bbox=[x1 + x, y1 + y, x2 + x, y2 + y]))
+                tiles.append(tile)
+        if len(lines) < 2:
+            return lines
+        boxes = np.array([line["bbox"] for line in lines], dtype=np.float64)
+        tiles = np.array(tiles)
+        # 只有与其他分块范围相交（位于重叠区域内）的文本行才可能重复
+        origins = np.array(offsets, dtype=np.float64)
+        inside = (boxes[:, None, 2] > origins[None, :, 0]) & (boxes[:, None, 0] < origins[None, :, 0] + OCR_TILE_SIZE) & \
+                 (boxes[:, None, 3] > origins[None, :, 1]) & (boxes[:, None, 1] < origins[None, :, 1] + OCR_TILE_SIZE)
+        inside[np.arange(len(lines)), tiles] = False
+        candidates = np.flatnonzero(inside.any(1))
+        keep = np.ones(len(lines), dtype=bool)
+        if len(candidates) > 1:
+            b = boxes[candidates]
+            iw = np.minimum(b[:, None, 2], b[None, :, 2]) - np.maximum(b[:, None, 0], b[None, :, 0])
+            ih = np.minimum(b[:, None, 3], b[None, :, 3]) - np.maximum(b[:, None, 1], b[None, :, 1])
+            inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+            area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+            smaller = np.maximum(np.minimum(area[:, None], area[None, :]), 1e-6)
+            duplicate = (inter / smaller > 0.5) & (tiles[candidates][:, None] != tiles[candidates][None, :])
+            # 与更大（或面积相同但下标更小）的文本行重复时丢弃
+            larger = (area[None, :] > area[:, None]) | \
+                     ((area[None, :] == area[:, None]) & (candidates[None, :] < candidates[:, None]))
+            keep[candidates[(duplicate & larger).any(1)]] = False
+        return [line for line, kept in zip(lines, keep) if kept]
+
+    async def query_ocr(self, images_base64: List[str],
+                        sorted: bool, priority: str = "interactive") -> List[dict]:
+        return await self.query_sources(self.load_image, images_base64, sorted, priority)
+
+    async def query_ocr_files(self, files: List[BinaryIO],
+                              sorted: bool, priority: str = "interactive") -> List[dict]:
+        return await self.query_sources(self.load_file, files, sorted, priority)
+
+    async def query_sources(self, loader, sources: list, sorted: bool, priority: str) -> List[dict]:
+        # 一个请求内的图片并行解码后作为一批送入检测和识别，再按原顺序拆回每张图片的结果
+        results = [None] * len(sources)
+        stream = self.iter_sources(loader, sources, sorted, priority)
+        try:
+            async for indices, result, error in stream:
+                if error is not None:
+                    raise error
+                for i in indices:
+                    results[i] = result
+            return results
         except Exception as e:
             logging.error(f"OCR 处理失败: {e}")
             raise HTTPException(status_code=400, detail=f"OCR 处理失败: {str(e)}")
+        finally:
+            await stream.aclose()
+
+    async def iter_sources(self, loader, sources: list, sorted: bool, priority: str):
+        """逐张产出 (图片下标列表, 结果, 异常)，内容相同的图片共用一个结果。
+
+        缓存命中的图片最先产出；其余图片一起提交给调度器，每张图片所在的批次完成后立即产出。
+        """
+        loop = asyncio.get_running_loop()
+        loaded = await asyncio.gather(
+            *[loop.run_in_executor(decode_pool, loader, source) for source in sources], return_exceptions=True)
+        # 同一请求中内容相同的图片只识别一次
+        groups, unique = OrderedDict(), {}
+        for i, item in enumerate(loaded):
+            if item is None:
+                yield [i], {"text": "", "lines": []}, None
+            elif isinstance(item, Exception):
+                yield [i], None, item
+            else:
+                groups.setdefault(item[0], []).append(i)
+                unique.setdefault(item[0], item[1])
+        if not groups:
+            return
+
+        found = await loop.run_in_executor(decode_pool, self.cache.get_many, list(groups))
+        for key, lines in found.items():
+            yield groups[key], Chat.format_lines(lines, sorted), None
+        missing = [key for key in groups if key not in found]
+        if not missing:
+            return
+
+        tiled = await asyncio.gather(
+            *[loop.run_in_executor(decode_pool, Chat.decode_tiles, unique[key]) for key in missing],
+            return_exceptions=True)
+        # 所有分块一起送入调度器，识别后按图片合并
+        decoded = [(key, item[0], item[1]) for key, item in zip(missing, tiled) if not isinstance(item, Exception)]
+        futures = iter(self.scheduler.submit([tile for _, tiles, _ in decoded for tile, _ in tiles], priority))
+        tasks = [asyncio.ensure_future(Chat.collect_tiles(key, tiles, scale, [next(futures) for _ in tiles]))
+                 for key, tiles, scale in decoded]
+        try:
+            for key, tiles in zip(missing, tiled):
+                if isinstance(tiles, Exception):
+                    yield groups[key], None, tiles
+            for task in asyncio.as_completed(tasks):
+                key, lines, error = await task
+                if error is not None:
+                    yield groups[key], None, error
+                    continue
+                await loop.run_in_executor(decode_pool, self.cache.put_many, {key: lines})
+                yield groups[key], Chat.format_lines(lines, sorted), None
+        finally:
+            for task in tasks:
+                task.cancel()
 
     @staticmethod
-    def sort_text_lines(text_lines: List[str]) -> List[str]:
-        # 这里可以实现自定义的排序逻辑
-        # 目前只是简单地返回原始列表，因为我们没有位置信息来进行排序
-        return text_lines
+    async def collect_tiles(key: str, tiles: list, scale: Tuple[float, float],
+                            futures: List[asyncio.Future]) -> Tuple[str, Optional[List[dict]], Optional[Exception]]:
+        try:
+            ocr_results = await asyncio.gather(*futures)
+        except Exception as e:
+            return key, None, e
+        tile_lines = [Chat.result_lines(ocr_result) for ocr_result in ocr_results]
+        return key, Chat.scale_lines(Chat.merge_tiles(tile_lines, [offset for _, offset in tiles]), scale), None
+
+    @staticmethod
+    def result_lines(ocr_result: OCRResult) -> List[dict]:
+        return [{"text": text_line.text, "bbox": [float(v) for v in text_line.bbox],
+                 "confidence": text_line.confidence} for text_line in ocr_result.text_lines]
+
+    @staticmethod
+    def format_lines(lines: List[dict], sorted: bool) -> dict:
+        if not sorted:
+            # 将所有文本行合并成一个字符串，用换行符分隔
+            return {"text": "\n".join(line["text"] for line in lines), "lines": lines}
+        # 按阅读顺序排序，同一行的文本用空格连接
+        rows = Chat.sort_text_lines(lines)
+        return {"text": "\n".join(" ".join(line["text"] for line in row) for row in rows),
+                "lines": [line for row in rows for line in row]}
+
+    @staticmethod
+    def sort_text_lines(lines: List[dict]) -> List[List[dict]]:
+        # 根据 bbox 排序，返回按阅读顺序排列的行，每行内从左到右
+        if len(lines) == 0:
+            return []
+        order, rows = Chat.reading_order(np.array([line["bbox"] for line in lines], dtype=np.float64))
+        splits = np.flatnonzero(np.diff(rows)) + 1
+        return [[lines[i] for i in part] for part in np.split(order, splits)]
+
+    @staticmethod
+    def reading_order(bboxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """计算文本行的阅读顺序，bboxes 为 (n, 4) 的 [x1, y1, x2, y2]。
+
+        1. 横跨多栏的宽文本行（标题等）把页面切成上下若干段，段与宽行按从上到下排列；
+        2. 由窄文本行在 x 轴上的投影找出贯穿整页的空白竖缝，把页面分栏，段内逐栏阅读；
+           竖缝两侧的文本行大多处在同一行（表格、键值对表单）且至少一侧是短文本时不算分栏；
+        3. 栏内按 y 中点排序，相邻中点之差小于半个行高的归为同一行，行内按 x 排序。
+
+        返回 (order, rows)：order 为排序后的下标，rows 为排序后每个文本行所属的行号（单调不减）。
+        """
+        n = len(bboxes)
+        x1, y1, x2, y2 = bboxes.T
+        y_mid = (y1 + y2) / 2
+        line_height = max(float(np.median(y2 - y1)), 1.0)
+        left, right = float(x1.min()), float(x2.max())
+
+        # 分栏：宽度超过内容区 60% 的文本行视为跨栏行，不参与竖缝检测
+        spanning = (x2 - x1) > 0.6 * (right - left)
+        boundaries = Chat.column_boundaries(x1[~spanning] - left, x2[~spanning] - left, 2 * line_height) + left
+        boundaries = Chat.filter_gutters(boundaries, (x1 + x2)[~spanning] / 2, (x2 - x1)[~spanning],
+                                         y_mid[~spanning], line_height)
+        column = np.searchsorted(boundaries, (x1 + x2) / 2)
+
+        # 分段：普通行的段号为其上方跨栏行的个数 * 2，跨栏行自身为奇数段号
+        span_y = np.sort(y_mid[spanning])
+        band = np.searchsorted(span_y, y_mid) * 2
+        band[spanning] = np.searchsorted(span_y, y_mid[spanning]) * 2 + 1
+        column[spanning] = 0
+
+        # 栏内按 y 中点聚类成行
+        order = np.lexsort((y_mid, column, band))
+        group = band[order] * (len(boundaries) + 1) + column[order]
+        new_row = np.ones(n, dtype=bool)
+        new_row[1:] = (np.diff(y_mid[order]) > 0.5 * line_height) | (np.diff(group) != 0)
+        row_of = np.empty(n, dtype=np.int64)
+        row_of[order] = np.cumsum(new_row)
+
+        order = np.lexsort((x1, row_of))
+        return order, row_of[order]
+
+    @staticmethod
+    def filter_gutters(boundaries: np.ndarray, x_mid: np.ndarray, widths: np.ndarray, y_mid: np.ndarray,
+                       line_height: float, shared_ratio: float = 0.5, min_column_width: float = 8) -> np.ndarray:
+        # 逐条检查竖缝两侧相邻的两栏：较少一侧的文本行中超过 shared_ratio 能在另一侧找到同一行的文本，
+        # 说明是表格或表单；此时只有两侧都是正文宽度（中位宽度不小于 min_column_width 个行高）的文本栏才保留
+        if len(boundaries) == 0:
+            return boundaries
+        column = np.searchsorted(boundaries, x_mid)
+        keep = np.ones(len(boundaries), dtype=bool)
+        for k in range(len(boundaries)):
+            left, right = column == k, column == k + 1
+            if not left.any() or not right.any():
+                continue
+            a, b = np.sort(y_mid[left]), np.sort(y_mid[right])
+            if len(a) > len(b):
+                a, b = b, a
+            # 每个文本行与另一侧 y 中点最近的文本行的距离，两端补哨兵
+            b = np.concatenate(([-np.inf], b, [np.inf]))
+            pos = np.searchsorted(b, a)
+            nearest = np.minimum(b[pos] - a, a - b[pos - 1])
+            shared = np.mean(nearest < 0.5 * line_height)
+            wide = min(np.median(widths[left]), np.median(widths[right])) >= min_column_width * line_height
+            keep[k] = shared <= shared_ratio or wide
+        return boundaries[keep]
+
+    @staticmethod
+    def column_boundaries(x1: np.ndarray, x2: np.ndarray, min_gap: float) -> np.ndarray:
+        # 统计每个 x 坐标被多少文本行覆盖，覆盖数为 0 且宽度不小于 min_gap 的区间为栏间空白，返回空白中点
+        if len(x1) < 2:
+            return np.empty(0)
+        width = int(np.ceil(x2.max())) + 1
+        diff = np.zeros(width + 1, dtype=np.int64)
+        np.add.at(diff, np.clip(np.floor(x1).astype(np.int64), 0, width), 1)
+        np.add.at(diff, np.clip(np.ceil(x2).astype(np.int64), 0, width), -1)
+        empty = np.cumsum(diff[:width]) == 0
+        # 只看内容区内部的空白
+        empty[:int(np.floor(x1.min())) + 1] = False
+        edges = np.diff(empty.astype(np.int8))
+        starts = np.flatnonzero(edges == 1) + 1
+        ends = np.flatnonzero(edges == -1) + 1
+        ends = ends[ends > starts[0]] if len(starts) else ends
+        starts, ends = starts[:len(ends)], ends[:len(starts)]
+        wide = (ends - starts) >= min_gap
+        return (starts[wide] + ends[wide]) / 2
+
+def build_response(results: List[dict], return_lines: bool) -> dict:
+    response = {"error": None, "results": [result["text"] for result in results]}
+    if return_lines:
+        response["lines"] = [result["lines"] for result in results]
+    return response
 
 @app.post('/v1/ocr/text')
 async def handle_post_request(
@@ -139,15 +699,108 @@ async def handle_post_request(
         raise HTTPException(status_code=401, detail="无效的令牌")
     chat = Chat()
     try:
-        results = []
-        for image_base64 in image_req.images:
-            results.append(chat.query_ocr(image_base64, image_req.sorted))
-        return {"error": None, "results": results}
+        results = await chat.query_ocr(image_req.images, image_req.sorted, image_req.priority)
+        return build_response(results, image_req.return_lines)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logging.error(f"识别报错：{e}")
+        raise HTTPException(status_code=500, detail=f"识别出错: {str(e)}")
+
+@app.post('/v1/ocr/text/stream')
+async def handle_stream_request(
+    image_req: ImageReq,
+    format: Literal["ndjson", "sse"] = "ndjson",
+    credentials: HTTPAuthorizationCredentials = Security(security)):
+    # 每张图片识别完成后立即返回一条结果，而不是等整个请求完成
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="无效的令牌")
+    chat = Chat()
+    started = time.perf_counter()
+
+    def encode(event: dict) -> str:
+        data = json.dumps(event, ensure_ascii=False)
+        return f"data: {data}\n\n" if format == "sse" else data + "\n"
+
+    async def events():
+        stream = chat.iter_sources(chat.load_image, image_req.images, image_req.sorted, image_req.priority)
+        try:
+            async for indices, result, error in stream:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                if error is not None:
+                    logging.error(f"OCR 处理失败: {error}")
+                for i in indices:
+                    if error is not None:
+                        yield encode({"index": i, "error": f"OCR 处理失败: {str(error)}", "elapsed_ms": elapsed_ms})
+                    else:
+                        yield encode({"index": i, "text": result["text"], "lines": result["lines"],
+                                      "elapsed_ms": elapsed_ms})
+            yield encode({"done": True, "elapsed_ms": (time.perf_counter() - started) * 1000})
+        finally:
+            await stream.aclose()
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type)
+
+@app.post('/v1/ocr/upload')
+async def handle_upload_request(
+    files: List[UploadFile] = File(...),
+    sorted: bool = Form(False),
+    priority: Literal["interactive", "bulk"] = Form("interactive"),
+    return_lines: bool = Form(False),
+    credentials: HTTPAuthorizationCredentials = Security(security)):
+    # multipart 上传图片文件，参数与 /v1/ocr/text 相同
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="无效的令牌")
+    chat = Chat()
+    try:
+        results = await chat.query_ocr_files([upload.file for upload in files], sorted, priority)
+        return build_response(results, return_lines)
     except HTTPException as he:
         raise he
     except Exception as e:
         logging.error(f"识别报错：{e}")
         raise HTTPException(status_code=500, detail=f"识别出错: {str(e)}")
+    finally:
+        for upload in files:
+            await upload.close()
+
+@app.post('/v1/ocr/raw')
+async def handle_raw_request(
+    request: Request,
+    sorted: bool = False,
+    priority: Literal["interactive", "bulk"] = "interactive",
+    return_lines: bool = False,
+    credentials: HTTPAuthorizationCredentials = Security(security)):
+    # 请求体为单张图片的原始字节，参数通过 query string 传递
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="无效的令牌")
+    chat = Chat()
+    # 边接收边写入临时文件，大图不在内存中多次拷贝
+    buffer = tempfile.SpooledTemporaryFile(max_size=OCR_SPOOL_MAX_MB * 1024 * 1024)
+    try:
+        async for chunk in request.stream():
+            buffer.write(chunk)
+        results = await chat.query_ocr_files([buffer], sorted, priority)
+        return build_response(results, return_lines)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logging.error(f"识别报错：{e}")
+        raise HTTPException(status_code=500, detail=f"识别出错: {str(e)}")
+    finally:
+        buffer.close()
+
+@app.get('/v1/ocr/stats')
+async def handle_stats_request(
+    credentials: HTTPAuthorizationCredentials = Security(security)):
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="无效的令牌")
+    return {"scheduler": ocr_scheduler.stats(), "cache": ocr_cache.stats()}
 
 if __name__ == "__main__":
     env_bearer_token = os.getenv("ACCESS_TOKEN")
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File: benchmark.py
+@Desc: Surya OCR 基准测试：用 Pillow 渲染合成文本页面，分别统计 base64 解码、检测、识别、后处理的耗时，
+       并扫描 BATCH_SIZE 和并发数，输出 JSON 报告
+
+用法：
+    python benchmark.py --pages 16 --batch-sizes 8,32,64 --concurrency 1,4
+    python benchmark.py --langs zh,en --font /usr/share/fonts/NotoSansCJK-Regular.ttc --output report.json
+    python benchmark.py --profile cprofile --profile-output ocr.prof   # 或 --profile py-spy（需安装 py-spy）
+"""
+import argparse
+import asyncio
+import base64
+import cProfile
+import importlib.util
+import io
+import json
+import os
+import pstats
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+WORDS = {
+    "en": ["invoice", "total", "amount", "dataset", "import", "knowledge", "search", "model", "report",
+           "page", "section", "table", "2024", "customer", "order", "delivery", "summary", "reference"],
+    "zh": ["知识库", "数据集", "导入", "检索", "模型", "发票", "金额", "合计", "客户", "订单", "报告",
+           "章节", "表格", "说明", "问答", "文档", "识别", "图片"],
+}
+FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+]
+
+
+def int_list(value: str):
+    return [int(v) for v in value.split(",") if v]
+
+
+def load_app(path: str):
+    path = os.path.abspath(path)
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location("ocr_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def find_font(path: str = None):
+    for candidate in [path] + FONT_CANDIDATES:
+        if candidate and os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def load_font(font_path: str, size: int):
+    if font_path:
+        return ImageFont.truetype(font_path, size)
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def render_page(rng: random.Random, width: int, lines: int, font_size: int, lang: str, font_path: str) -> Image.Image:
+    # 白底黑字，行高为字号的 1.6 倍，每行长度随机
+    font = load_font(font_path, font_size)
+    line_height = int(font_size * 1.6)
+    image = Image.new("RGB", (width, line_height * lines + 2 * font_size), "white")
+    draw = ImageDraw.Draw(image)
+    sep = "" if lang == "zh" else " "
+    for i in range(lines):
+        text = sep.join(rng.choice(WORDS[lang]) for _ in range(rng.randint(3, 12)))
+        draw.text((font_size, font_size + i * line_height), text, fill="black", font=font)
+    return image
+
+
+def make_pages(count: int, widths, line_counts, font_sizes, langs, font_path: str, seed: int):
+    rng = random.Random(seed)
+    pages = []
+    for i in range(count):
+        lang = langs[i % len(langs)]
+        meta = {"lang": lang, "width": rng.choice(widths), "lines": rng.choice(line_counts),
+                "font_size": rng.choice(font_sizes)}
+        image = render_page(rng, meta["width"], meta["lines"], meta["font_size"], lang, font_path)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        meta["height"] = image.height
+        pages.append((meta, base64.b64encode(buffer.getvalue()).decode()))
+    return pages
+
+
+def time_stages(module, surya, pages_base64, batch_size: int) -> dict:
+    # 复现 run_ocr 的各个阶段并分别计时
+    from surya.detection import batch_text_detection
+    from surya.input.processing import slice_polys_from_image
+    from surya.recognition import batch_recognition
+
+    timings = {}
+    start = time.perf_counter()
+    images = [module.Chat.open_image(base64.b64decode(page))[0] for page in pages_base64]
+    timings["decode_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    detections = batch_text_detection(images, surya.det_model, surya.det_processor)
+    timings["detection_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    slices, langs, polygons = [], [], []
+    for image, detection in zip(images, detections):
+        image_polygons = [box.polygon for box in detection.bboxes]
+        slices.extend(slice_polys_from_image(image, image_polygons))
+        langs.extend([surya.langs] * len(image_polygons))
+        polygons.append(image_polygons)
+    texts, confidences = batch_recognition(slices, langs, surya.rec_model, surya.rec_processor,
+                                           batch_size=batch_size)
+    timings["recognition_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    offset = 0
+    for image_polygons in polygons:
+        lines = []
+        for polygon, text, confidence in zip(image_polygons, texts[offset:], confidences[offset:]):
+            xs, ys = [p[0] for p in polygon], [p[1] for p in polygon]
+            lines.append({"text": text, "bbox": [min(xs), min(ys), max(xs), max(ys)], "confidence": confidence})
+        offset += len(image_polygons)
+        module.Chat.format_lines(lines, True)
+    timings["postprocess_ms"] = (time.perf_counter() - start) * 1000
+
+    total = sum(timings.values())
+    timings.update({"batch_size": batch_size, "images": len(images), "lines": len(texts),
+                    "total_ms": total, "images_per_sec": len(images) / total * 1000 if total else 0.0})
+    return timings
+
+
+async def run_concurrency(module, pages_base64, concurrency: int, requests: int, images_per_request: int) -> dict:
+    # 端到端：经过解码线程池、跨请求调度器和后处理，统计请求延迟
+    chat = module.Chat()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        images = [pages_base64[(i * images_per_request + k) % len(pages_base64)] for k in range(images_per_request)]
+        async with semaphore:
+            start = time.perf_counter()
+            await chat.query_ocr(images, True)
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    elapsed = time.perf_counter() - started
+    latencies = np.array(latencies) * 1000
+    return {
+        "concurrency": concurrency, "requests": requests, "images_per_request": images_per_request,
+        "p50_ms": float(np.percentile(latencies, 50)), "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "images_per_sec": requests * images_per_request / elapsed,
+    }
+
+
+def run(args) -> dict:
+    module = load_app(args.app)
+    surya = module.Surya()
+    font_path = find_font(args.font)
+    langs = args.langs
+    if font_path is None and "zh" in langs:
+        print("未找到中文字体（可用 --font 指定），只渲染英文页面", file=sys.stderr)
+        langs = [lang for lang in langs if lang != "zh"] or ["en"]
+    pages = make_pages(args.pages, args.widths, args.lines, args.font_sizes, langs, font_path, args.seed)
+    pages_base64 = [page for _, page in pages]
+
+    report = {
+        "config": {k: getattr(args, k) for k in ("pages", "widths", "lines", "font_sizes", "batch_sizes",
+                                                  "concurrency", "requests", "images_per_request", "seed")},
+        "langs": langs, "font": font_path,
+        "device": str(getattr(surya.det_model, "device", "unknown")),
+        "stages": [], "end_to_end": [],
+    }
+    time_stages(module, surya, pages_base64[:1], args.batch_sizes[0])  # 预热
+    for batch_size in args.batch_sizes:
+        item = time_stages(module, surya, pages_base64, batch_size)
+        report["stages"].append(item)
+        print(f"batch_size={batch_size}: decode {item['decode_ms']:.0f}ms, detection {item['detection_ms']:.0f}ms, "
+              f"recognition {item['recognition_ms']:.0f}ms, postprocess {item['postprocess_ms']:.0f}ms",
+              file=sys.stderr)
+        surya.batch_size = batch_size
+        for concurrency in args.concurrency:
+            item = asyncio.run(run_concurrency(module, pages_base64, concurrency, args.requests,
+                                               args.images_per_request))
+            item["batch_size"] = batch_size
+            report["end_to_end"].append(item)
+            print(f"batch_size={batch_size} concurrency={concurrency}: p50 {item['p50_ms']:.0f}ms, "
+                  f"p99 {item['p99_ms']:.0f}ms, {item['images_per_sec']:.2f} images/s", file=sys.stderr)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"))
+    parser.add_argument("--pages", type=int, default=16, help="合成页面数")
+    parser.add_argument("--widths", type=int_list, default=[800, 1240], help="页面宽度，逗号分隔")
+    parser.add_argument("--lines", type=int_list, default=[10, 40], help="每页行数，逗号分隔")
+    parser.add_argument("--font-sizes", type=int_list, default=[16, 24], help="字号，逗号分隔")
+    parser.add_argument("--langs", default="en,zh", help="页面语言，逗号分隔，可选 en、zh")
+    parser.add_argument("--font", default=None, help="字体文件路径，渲染中文需要 CJK 字体")
+    parser.add_argument("--batch-sizes", type=int_list, default=[8, 32, 64], help="识别 BATCH_SIZE，逗号分隔")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4], help="并发请求数，逗号分隔")
+    parser.add_argument("--requests", type=int, default=8, help="每个并发级别的请求数")
+    parser.add_argument("--images-per-request", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", choices=["cprofile", "py-spy"], default=None)
+    parser.add_argument("--profile-output", default=None, help="默认 ocr.prof（cprofile）或 ocr-profile.svg（py-spy）")
+    parser.add_argument("--output", default=None, help="报告输出路径，默认打印到 stdout")
+    args = parser.parse_args()
+    args.langs = [lang for lang in args.langs.split(",") if lang]
+    # 关闭结果缓存，重复的页面也要真正识别
+    os.environ["OCR_CACHE_SIZE"] = "0"
+    os.environ["OCR_CACHE_DIR"] = ""
+
+    if args.profile == "py-spy":
+        if shutil.which("py-spy") is None:
+            parser.error("未找到 py-spy，请先 pip install py-spy")
+        argv = [a for a in sys.argv[1:] if a not in ("--profile", "py-spy")]
+        output = args.profile_output or "ocr-profile.svg"
+        if "--profile-output" in argv:
+            i = argv.index("--profile-output")
+            del argv[i:i + 2]
+        sys.exit(subprocess.call(["py-spy", "record", "-o", output, "--", sys.executable,
+                                  os.path.abspath(__file__)] + argv))
+
+    if args.profile == "cprofile":
+        profiler = cProfile.Profile()
+        report = profiler.runcall(run, args)
+        output = args.profile_output or "ocr.prof"
+        profiler.dump_stats(output)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(20)
+        report["profile"] = {"output": output, "top_cumulative": summary.getvalue()}
+    else:
+        report = run(args)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
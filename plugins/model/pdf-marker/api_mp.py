@@ -1,34 +1,89 @@
 import asyncio
 import base64
-import fitz
+import hashlib
+import io
+import re
+import pypdfium2 as pdfium
 import torch.multiprocessing as mp
 import shutil
 import time
+import uuid
 from contextlib import asynccontextmanager
 from loguru import logger
 from fastapi import HTTPException, FastAPI, UploadFile, File
 import multiprocessing
-from marker.output import save_markdown
 from marker.convert import convert_single_pdf
 from marker.models import load_all_models
 import torch
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 import os
 app = FastAPI()
 model_lst = None
 model_refs = None
 temp_dir = "./temp"
-os.environ['PROCESSES_PER_GPU'] = str(2)
+os.environ.setdefault('PROCESSES_PER_GPU', str(2))
+# 运行模式：auto（有 GPU 时用 GPU，否则用 CPU）、cuda、cpu
+DEVICE_MODE = os.environ.get('DEVICE_MODE', 'auto')
+# CPU 模式下每个进程的 torch 线程数、每个进程预估占用的内存（GB），进程数默认按 CPU 核数和内存计算
+CPU_THREADS_PER_WORKER = int(os.environ.get('CPU_THREADS_PER_WORKER', 4))
+CPU_WORKER_MEM_GB = float(os.environ.get('CPU_WORKER_MEM_GB', 4))
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', 0))
+# 页数不少于 PDF_SHARD_THRESHOLD 的 PDF 按 PDF_SHARD_PAGES 页一段拆给多个进程并行转换，0 表示不拆分
+PDF_SHARD_THRESHOLD = int(os.environ.get('PDF_SHARD_THRESHOLD', 100))
+PDF_SHARD_PAGES = int(os.environ.get('PDF_SHARD_PAGES', 40))
+# marker 生成的图片名为 "{页码}_image_{序号}.png"，页码从分段的第一页算起
+IMAGE_NAME_PATTERN = re.compile(r"^(\d+)_image_(\d+)\.png$")
+IMAGE_LINK_PATTERN = re.compile(r"!\[([^\]]*)\]\(([^)\s]+)\)")
+# 上传文件分块写入磁盘，超过 UPLOAD_MAX_MB 时返回 413，0 表示不限制
+UPLOAD_MAX_MB = int(os.environ.get('UPLOAD_MAX_MB', 500))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 规划分段时在单独的线程中读取页数，不阻塞事件循环；PDFium 不是线程安全的，只用一个线程
+page_count_pool = ThreadPoolExecutor(max_workers=1)
 
-def worker_init(counter, lock):
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def available_memory():
+    # 优先使用容器（cgroup）的内存上限
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 60:
+                return int(value)
+        except OSError:
+            continue
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def pool_config():
+    # 返回 (运行模式, 进程数, CPU 模式下每个进程的线程数)
+    gpu_count = torch.cuda.device_count()
+    mode = DEVICE_MODE if DEVICE_MODE != 'auto' else ('cuda' if gpu_count > 0 else 'cpu')
+    if mode == 'cuda':
+        if gpu_count == 0:
+            raise RuntimeError("DEVICE_MODE=cuda but no GPU is available")
+        return mode, gpu_count * int(os.environ.get('PROCESSES_PER_GPU', 1)), 0
+    cpus = available_cpus()
+    workers = CPU_WORKERS or min(cpus // CPU_THREADS_PER_WORKER,
+                                 int(available_memory() / (CPU_WORKER_MEM_GB * 1024 ** 3)))
+    workers = max(1, workers)
+    # 线程数按进程数平分 CPU 核，避免多个进程的线程数之和超过核数
+    return mode, workers, max(1, cpus // workers)
+
+def worker_init(counter, lock, mode='cuda', cpu_threads=0):
     global model_lst
     num_gpus = torch.cuda.device_count()
     processes_per_gpu = int(os.environ.get('PROCESSES_PER_GPU', 1))
     with lock:
         worker_id = counter.value
         counter.value += 1
-    if num_gpus == 0:
+    if mode == 'cpu' or num_gpus == 0:
         device = 'cpu'
+        if cpu_threads:
+            torch.set_num_threads(cpu_threads)
     else:
         device_id = worker_id // processes_per_gpu
         if device_id >= num_gpus:
@@ -41,12 +96,55 @@ def worker_init(counter, lock):
             continue
         model.share_memory()
 
-def process_file_with_multiprocessing(temp_file_path):
+async def save_upload(file, path):
+    # 分块写入，边写边计算 sha256，避免把整个文件读入内存
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if UPLOAD_MAX_MB > 0 and size > UPLOAD_MAX_MB * 1024 * 1024:
+                raise HTTPException(status_code=413, detail=f"文件大小超过 {UPLOAD_MAX_MB}MB")
+            sha256.update(chunk)
+            f.write(chunk)
+    return size, sha256.hexdigest()
+
+def count_pages(path):
+    # 与 marker 使用同一个解析库，只读取文档结构，不加载页面内容
+    pdf_document = pdfium.PdfDocument(path)
+    try:
+        return len(pdf_document)
+    finally:
+        pdf_document.close()
+
+def page_shards(total_pages):
+    # 返回 [(起始页, 页数)]，不拆分时为 [(0, None)]
+    if PDF_SHARD_THRESHOLD <= 0 or PDF_SHARD_PAGES <= 0 or total_pages < PDF_SHARD_THRESHOLD:
+        return [(0, None)]
+    return [(start, min(PDF_SHARD_PAGES, total_pages - start)) for start in range(0, total_pages, PDF_SHARD_PAGES)]
+
+def rename_shard_images(full_text, images, start_page):
+    # 把分段内的相对页码换成整个文档的页码，避免不同分段的图片重名，并同步修改 markdown 中的引用
+    renamed = {}
+    for name in images:
+        match = IMAGE_NAME_PATTERN.match(name)
+        renamed[name] = f"{int(match.group(1)) + start_page}_image_{match.group(2)}.png" if match else f"{start_page}_{name}"
+
+    def replace(match):
+        alt, path = match.group(1), match.group(2)
+        return f"![{renamed.get(alt, alt)}]({renamed.get(path, path)})"
+
+    full_text = IMAGE_LINK_PATTERN.sub(replace, full_text)
+    return full_text, {renamed[name]: image for name, image in images.items()}
+
+def process_file_with_multiprocessing(temp_file_path, start_page=0, max_pages=None):
     global model_lst
-    full_text, images, out_meta = convert_single_pdf(temp_file_path, model_lst, batch_multiplier=1)
-    fname = os.path.basename(temp_file_path)
-    subfolder_path = save_markdown(r'./result', fname, full_text, images, out_meta)
-    md_content_with_base64_images = embed_images_as_base64(full_text, subfolder_path)
+    full_text, images, out_meta = convert_single_pdf(temp_file_path, model_lst, max_pages=max_pages,
+                                                     start_page=start_page, batch_multiplier=1)
+    if max_pages is not None:
+        full_text, images = rename_shard_images(full_text, images, start_page)
+    # 直接在子进程中把内存里的图片编码进 markdown，不再落盘
+    md_content_with_base64_images = embed_images_as_base64(full_text, images)
     return md_content_with_base64_images, out_meta
 
 @asynccontextmanager
@@ -59,8 +157,12 @@ async def lifespan(app: FastAPI):
     worker_counter = manager.Value('i', 0)
     worker_lock = manager.Lock()
     global my_pool
-    gpu_count = torch.cuda.device_count()
-    my_pool = ProcessPoolExecutor(max_workers=gpu_count*int(os.environ.get('PROCESSES_PER_GPU', 1)), initializer=worker_init, initargs=(worker_counter, worker_lock))
+    mode, max_workers, cpu_threads = pool_config()
+    if mode == 'cpu':
+        # 子进程启动时继承，限制 OpenMP/MKL 线程数
+        os.environ['OMP_NUM_THREADS'] = os.environ['MKL_NUM_THREADS'] = str(cpu_threads)
+    logger.info(f"Starting {max_workers} workers on {mode}" + (f", {cpu_threads} threads each" if mode == 'cpu' else ""))
+    my_pool = ProcessPoolExecutor(max_workers=max_workers, initializer=worker_init, initargs=(worker_counter, worker_lock, mode, cpu_threads))
 
     yield
     global temp_dir
@@ -72,22 +174,41 @@ async def lifespan(app: FastAPI):
 
 app.router.lifespan_context = lifespan
 
+async def run_shards(temp_file_path, shards):
+    global my_pool
+    futures = [my_pool.submit(process_file_with_multiprocessing, temp_file_path, start_page, max_pages)
+               for start_page, max_pages in shards]
+    try:
+        return await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+    except BaseException:
+        # 任一分段失败时取消还在排队的分段，并等正在运行的分段结束，之后才能删除临时文件
+        for future in futures:
+            future.cancel()
+        await asyncio.get_event_loop().run_in_executor(None, wait, futures)
+        raise
+
 @app.post("/v1/parse/file")
 async def read_file(
         file: UploadFile = File(...)):
+    temp_file_path = None
     try:
         start_time = time.time()
         global temp_dir
         os.makedirs(temp_dir, exist_ok=True)
-        temp_file_path = os.path.join(temp_dir, file.filename)
-        with open(temp_file_path, "wb") as temp_file:
-            temp_file.write(await file.read())
-        pdf_document = fitz.open(temp_file_path)
-        total_pages = pdf_document.page_count
-        pdf_document.close()
-        global my_pool
-        loop = asyncio.get_event_loop()
-        md_content_with_base64_images, out_meta = await loop.run_in_executor(my_pool, process_file_with_multiprocessing, temp_file_path)
+        # 临时文件名不使用上传的文件名，避免同名文件并发时互相覆盖
+        temp_file_path = os.path.join(temp_dir, f"{uuid.uuid4().hex}.pdf")
+        size, sha256 = await save_upload(file, temp_file_path)
+        logger.info(f"{file.filename}: {size} bytes, sha256 {sha256}")
+        # 不拆分时直接交给子进程，页数由子进程打开文档时统计
+        if PDF_SHARD_THRESHOLD > 0:
+            total_pages = await asyncio.get_event_loop().run_in_executor(page_count_pool, count_pages, temp_file_path)
+            shards = page_shards(total_pages)
+        else:
+            shards = [(0, None)]
+        # 大文件按页拆分到多个进程并行转换，再按页序拼接
+        results = await run_shards(temp_file_path, shards)
+        md_content_with_base64_images = "\n\n".join(markdown for markdown, _ in results)
+        total_pages = sum(out_meta.get("pages", 0) for _, out_meta in results)
 
         end_time = time.time()
         duration = end_time - start_time
@@ -98,10 +219,13 @@ async def read_file(
                 "data": {
                     "markdown": md_content_with_base64_images,
                     "page": total_pages,
-                    "duration": duration
+                    "duration": duration,
+                    "sha256": sha256
                 }
             }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(e)
         raise HTTPException(status_code=500, detail=f"错误信息: {str(e)}")
@@ -110,30 +234,24 @@ async def read_file(
 
         if temp_file_path and os.path.exists(temp_file_path):
             os.remove(temp_file_path)
-def img_to_base64(img_path):
-    with open(img_path, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode('utf-8')
-def embed_images_as_base64(md_content, image_dir):
-    lines = md_content.split('\n')
-    new_lines = []
-    for line in lines:
-        if line.startswith("![") and "](" in line and ")" in line:
-            start_idx = line.index("](") + 2
-            end_idx = line.index(")", start_idx)
-            img_rel_path = line[start_idx:end_idx]
-
-            img_name = os.path.basename(img_rel_path)
-            img_path = os.path.join(image_dir, img_name)
-
-            if os.path.exists(img_path):
-                img_base64 = img_to_base64(img_path)
-                new_line = f'{line[:start_idx]}data:image/png;base64,{img_base64}{line[end_idx:]}'
-                new_lines.append(new_line)
-            else:
-                new_lines.append(line)
-        else:
-            new_lines.append(line)
-    return '\n'.join(new_lines)
+def img_to_base64(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+def embed_images_as_base64(md_content, images):
+    # 一次正则替换，把 markdown 中引用的图片名换成 base64 data URI，同一张图片只编码一次
+    encoded = {}
+
+    def replace(match):
+        alt, path = match.group(1), match.group(2)
+        name = os.path.basename(path)
+        if name not in images:
+            return match.group(0)
+        if name not in encoded:
+            encoded[name] = img_to_base64(images[name])
+        return f"![{alt}](data:image/png;base64,{encoded[name]})"
+
+    return IMAGE_LINK_PATTERN.sub(replace, md_content)
 
 if __name__ == "__main__":
     import uvicorn
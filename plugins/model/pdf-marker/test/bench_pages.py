@@ -0,0 +1,109 @@
+"""
+PDF 解析服务吞吐测试：并发上传 PDF，统计每分钟处理的页数，用于评估 CPU 节点的进程数/线程数配置。
+
+同时适用于 pdf-marker（/v1/parse/file）和 pdf-mineru（/v2/parse/file）：
+
+    python test/bench_pages.py --url http://127.0.0.1:7231/v1/parse/file --files 4 --pages 10 --concurrency 2
+    python test/bench_pages.py --url http://127.0.0.1:7231/v2/parse/file --pdf a.pdf --pdf b.pdf
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+import requests
+
+EN_WORDS = ["document", "parsing", "knowledge", "base", "markdown", "table", "figure", "section",
+            "result", "model", "throughput", "latency", "page", "dataset", "import", "summary"]
+ZH_WORDS = ["知识库", "文档", "解析", "表格", "图片", "章节", "结果", "模型", "数据集", "导入", "总结"]
+
+
+def make_pdf(path, pages, seed):
+    # 合成文本 PDF：每页一个标题和若干段中英文混排的正文
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for pnum in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Section {pnum + 1}", fontsize=18)
+        y = 110
+        while y < page.rect.height - 72:
+            if rng.random() < 0.3:
+                text = "".join(rng.choice(ZH_WORDS) for _ in range(rng.randint(6, 14)))
+                page.insert_text((72, y), text, fontsize=11, fontname="china-s")
+            else:
+                text = " ".join(rng.choice(EN_WORDS) for _ in range(rng.randint(6, 12)))
+                page.insert_text((72, y), text, fontsize=11)
+            y += 18
+    doc.save(path)
+    doc.close()
+
+
+def count_pages(path):
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+def parse(url, path, token):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        response = requests.post(url, files={"file": (os.path.basename(path), f, "application/pdf")},
+                                 headers=headers, timeout=3600)
+    return response.status_code, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:7231/v1/parse/file")
+    parser.add_argument("--token", default=None)
+    parser.add_argument("--pdf", action="append", default=[], help="待测试的 PDF，可重复；不指定时生成合成 PDF")
+    parser.add_argument("--files", type=int, default=4, help="合成 PDF 的数量")
+    parser.add_argument("--pages", type=int, default=10, help="每个合成 PDF 的页数")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=1, help="所有文件重复提交的轮数")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = list(args.pdf)
+        if not paths:
+            for i in range(args.files):
+                path = os.path.join(temp_dir, f"bench_{i}.pdf")
+                make_pdf(path, args.pages, i)
+                paths.append(path)
+        pages = {path: count_pages(path) for path in paths}
+        jobs = paths * args.rounds
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda path: parse(args.url, path, args.token), jobs))
+        elapsed = time.perf_counter() - started
+
+    ok = [(path, latency) for path, (status, latency) in zip(jobs, results) if status == 200]
+    total_pages = sum(pages[path] for path, _ in ok)
+    latencies = sorted(latency for _, latency in ok)
+    report = {
+        "url": args.url,
+        "files": len(jobs),
+        "failed": len(jobs) - len(ok),
+        "pages": total_pages,
+        "concurrency": args.concurrency,
+        "elapsed_s": elapsed,
+        "pages_per_min": total_pages / elapsed * 60 if elapsed else 0.0,
+        "avg_s_per_page": sum(latencies) / total_pages if total_pages else None,
+        "p50_s": latencies[len(latencies) // 2] if latencies else None,
+        "p95_s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
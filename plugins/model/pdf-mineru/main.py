@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 from base64 import b64encode
@@ -9,7 +10,7 @@ import uvicorn
 from fastapi import FastAPI, UploadFile, File
 from fastapi.responses import JSONResponse
 from loguru import logger
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkstemp
 from pathlib import Path
 import fitz  # PyMuPDF
 import asyncio
@@ -23,6 +24,7 @@ import magic_pdf.model as model_config
 from magic_pdf.config.enums import SupportedPdfParseMethod
 from magic_pdf.data.data_reader_writer import DataWriter, FileBasedDataWriter
 from magic_pdf.data.dataset import PymuDocDataset
+from magic_pdf.libs.config_reader import read_config
 from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
 from magic_pdf.operators.models import InferenceResult
 from magic_pdf.operators.pipes import PipeResult
@@ -33,6 +35,19 @@ app = FastAPI()
 
 process_variables = {}
 my_pool = None
+cpu_config_path = None
+# 运行模式：auto（有 GPU 时用 GPU，否则用 CPU）、cuda、cpu；CPU 模式下 magic-pdf.json 的 "device-mode" 会被强制为 cpu
+DEVICE_MODE = os.environ.get('DEVICE_MODE', 'auto')
+# CPU 模式下每个进程的 torch 线程数、每个进程预估占用的内存（GB），进程数默认按 CPU 核数和内存计算
+CPU_THREADS_PER_WORKER = int(os.environ.get('CPU_THREADS_PER_WORKER', 4))
+CPU_WORKER_MEM_GB = float(os.environ.get('CPU_WORKER_MEM_GB', 6))
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', 0))
+# 上传文件分块写入磁盘，超过 UPLOAD_MAX_MB 时返回 413，0 表示不限制
+UPLOAD_MAX_MB = int(os.environ.get('UPLOAD_MAX_MB', 500))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLargeError(Exception):
+    pass
 
 class MemoryDataWriter(DataWriter):
     def __init__(self):
@@ -53,14 +68,78 @@ class MemoryDataWriter(DataWriter):
     def close(self):
         self.buffer.close()
 
-def worker_init(counter, lock):
+async def save_upload(file: UploadFile, path: str) -> Tuple[int, str]:
+    # 分块写入，边写边计算 sha256，避免把整个文件读入内存
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if UPLOAD_MAX_MB > 0 and size > UPLOAD_MAX_MB * 1024 * 1024:
+                raise UploadTooLargeError(f"File exceeds {UPLOAD_MAX_MB}MB")
+            sha256.update(chunk)
+            f.write(chunk)
+    return size, sha256.hexdigest()
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def available_memory():
+    # 优先使用容器（cgroup）的内存上限
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 60:
+                return int(value)
+        except OSError:
+            continue
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def pool_config():
+    # 返回 (运行模式, 进程数, CPU 模式下每个进程的线程数)
+    gpu_count = torch.cuda.device_count()
+    mode = DEVICE_MODE if DEVICE_MODE != 'auto' else ('cuda' if gpu_count > 0 else 'cpu')
+    if mode == 'cuda':
+        if gpu_count == 0:
+            raise RuntimeError("DEVICE_MODE=cuda but no GPU is available")
+        return mode, gpu_count * int(os.environ.get('PROCESSES_PER_GPU', 1)), 0
+    cpus = available_cpus()
+    workers = CPU_WORKERS or min(cpus // CPU_THREADS_PER_WORKER,
+                                 int(available_memory() / (CPU_WORKER_MEM_GB * 1024 ** 3)))
+    workers = max(1, workers)
+    # 线程数按进程数平分 CPU 核，避免多个进程的线程数之和超过核数
+    return mode, workers, max(1, cpus // workers)
+
+def force_cpu_config():
+    # magic-pdf 从 magic-pdf.json 读取 device-mode，CPU 模式下若配置为 cuda 等设备，
+    # 写一份 device-mode 为 cpu 的副本，通过 MINERU_TOOLS_CONFIG_JSON 交给子进程使用
+    global cpu_config_path
+    config = read_config()
+    device = config.get('device-mode') or 'cpu'
+    if device == 'cpu':
+        return
+    logger.warning(f"magic-pdf device-mode is {device!r} but no GPU is used, forcing cpu for workers")
+    config['device-mode'] = 'cpu'
+    fd, cpu_config_path = mkstemp(prefix='magic-pdf-cpu-', suffix='.json')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    os.environ['MINERU_TOOLS_CONFIG_JSON'] = cpu_config_path
+
+def worker_init(counter, lock, mode='cuda', cpu_threads=0):
     num_gpus = torch.cuda.device_count()
     processes_per_gpu = int(os.environ.get('PROCESSES_PER_GPU', 1))
     with lock:
         worker_id = counter.value
         counter.value += 1
-    if num_gpus == 0:
+    if mode == 'cpu' or num_gpus == 0:
         device = 'cpu'
+        device_id = ''
+        if cpu_threads:
+            torch.set_num_threads(cpu_threads)
     else:
         device_id = worker_id // processes_per_gpu
         if device_id >= num_gpus:
@@ -113,6 +192,11 @@ def process_pdf(pdf_path, output_dir):
         
         with open(str(pdf_path), "rb") as f:
             pdf_bytes = f.read()
+        # 页数取自解析时打开的同一个文档
+        try:
+            ds = PymuDocDataset(pdf_bytes)
+        except fitz.FileDataError:
+            return {"status": "error", "code": 400, "message": "Invalid PDF file", "file": str(pdf_path)}
         
         output_path = Path(output_dir) / f"{Path(pdf_path).stem}_output"
         os.makedirs(str(output_path), exist_ok=True)
@@ -121,7 +205,7 @@ def process_pdf(pdf_path, output_dir):
         image_writer = FileBasedDataWriter(str(output_path))
         
         # 处理 PDF
-        infer_result, pipe_result = process_pdf_content(pdf_bytes, parse_method, image_writer)
+        infer_result, pipe_result = process_pdf_content(ds, parse_method, image_writer)
         
         md_content_writer = MemoryDataWriter()
         pipe_result.dump_md(md_content_writer, "", "images")
@@ -146,7 +230,7 @@ def process_pdf(pdf_path, output_dir):
                     original_names.append(os.path.basename(img_rel_path))
             
             # 提取图片并映射
-            with fitz.open(pdf_path) as doc:
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
                 img_counter = 0
                 for page_num, page in enumerate(doc):
                     for img_index, img in enumerate(page.get_images(full=True)):
@@ -174,6 +258,7 @@ def process_pdf(pdf_path, output_dir):
         return {
             "status": "success",
             "text": md_content,
+            "pages": len(ds),
             "output_path": str(output_path),
             "images": image_paths
         }
@@ -185,8 +270,7 @@ def process_pdf(pdf_path, output_dir):
             "file": str(pdf_path)
         }
 
-def process_pdf_content(pdf_bytes, parse_method, image_writer):
-    ds = PymuDocDataset(pdf_bytes)
+def process_pdf_content(ds, parse_method, image_writer):
     infer_result: InferenceResult = None
     pipe_result: PipeResult = None
 
@@ -216,12 +300,19 @@ async def lifespan(app: FastAPI):
     manager = mp.Manager()
     worker_counter = manager.Value('i', 0)
     worker_lock = manager.Lock()
-    gpu_count = torch.cuda.device_count()
-    my_pool = ProcessPoolExecutor(max_workers=gpu_count * int(os.environ.get('PROCESSES_PER_GPU', 1)), 
-                                  initializer=worker_init, initargs=(worker_counter, worker_lock))
+    mode, max_workers, cpu_threads = pool_config()
+    if mode == 'cpu':
+        # 子进程启动时继承，限制 OpenMP/MKL 线程数
+        os.environ['OMP_NUM_THREADS'] = os.environ['MKL_NUM_THREADS'] = str(cpu_threads)
+        force_cpu_config()
+    logger.info(f"Starting {max_workers} workers on {mode}" + (f", {cpu_threads} threads each" if mode == 'cpu' else ""))
+    my_pool = ProcessPoolExecutor(max_workers=max_workers,
+                                  initializer=worker_init, initargs=(worker_counter, worker_lock, mode, cpu_threads))
     yield
     if my_pool:
         my_pool.shutdown(wait=True)
+    if cpu_config_path and os.path.exists(cpu_config_path):
+        os.remove(cpu_config_path)
     print("Application shutdown, cleaning up...")
 
 app.router.lifespan_context = lifespan
@@ -230,19 +321,13 @@ app.router.lifespan_context = lifespan
 async def process_pdfs(file: UploadFile = File(...)):
     s_time = time.time()
     with TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir) / file.filename
-        with open(str(temp_path), "wb") as buffer:
-            buffer.write(await file.read())
-        
-        # 验证 PDF 文件
+        # 临时文件名不使用上传的文件名，避免路径中的特殊字符
+        temp_path = Path(temp_dir) / "upload.pdf"
         try:
-            with fitz.open(str(temp_path)) as pdf_document:
-                total_pages = pdf_document.page_count
-        except fitz.fitz.FileDataError:
-            return JSONResponse(content={"success": False, "message": "", "error": "Invalid PDF file"}, status_code=400)
-        except Exception as e:
-            logger.error(f"Error opening PDF: {str(e)}")
-            return JSONResponse(content={"success": False, "message": "", "error": f"Internal server error: {str(e)}"}, status_code=500)
+            size, sha256 = await save_upload(file, str(temp_path))
+        except UploadTooLargeError as e:
+            return JSONResponse(content={"success": False, "message": "", "error": str(e)}, status_code=413)
+        logger.info(f"{file.filename}: {size} bytes, sha256 {sha256}")
         
         try:
             loop = asyncio.get_running_loop()
@@ -258,7 +343,7 @@ async def process_pdfs(file: UploadFile = File(...)):
                     "success": False,
                     "message": "",
                     "error": results.get("message")
-                }, status_code=500)
+                }, status_code=results.get("code", 500))
             
             # 嵌入 Base64
             image_dir = os.path.join(results.get("output_path"), "images")
@@ -268,7 +353,8 @@ async def process_pdfs(file: UploadFile = File(...)):
                 "success": True,
                 "message": "",
                 "markdown": md_content_with_base64,
-                "pages": total_pages
+                "pages": results.get("pages"),
+                "sha256": sha256
             }
         except Exception as e:
             logger.error(f"Error in process_pdfs: {str(e)}")
@@ -0,0 +1,963 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time: 2023/11/7 22:45
+@Author: zhidong
+@File: reranker.py
+@Desc:
+"""
+import asyncio
+import os
+import queue
+import shutil
+import threading
+import time
+import numpy as np
+import torch
+import logging
+import uvicorn
+import datetime
+import gc
+import hashlib
+import inspect
+import json
+import math
+import operator
+import re
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from fastapi import FastAPI, Security, HTTPException
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from FlagEmbedding import FlagReranker
+from pydantic import Field, BaseModel, validator
+from typing import Optional, List, Tuple
+
+app = FastAPI()
+security = HTTPBearer()
+env_bearer_token = 'ACCESS_TOKEN'
+
+class CascadeConfig(BaseModel):
+    # 先用小模型给全部文档打分，保留 top_k（以及与第 k 名分差在 margin 内的文档），再交给请求的 model 精排
+    prefilter_model: Optional[str] = "bge-reranker-base"
+    top_k: int = Field(default=50, gt=0)
+    margin: Optional[float] = Field(default=0, ge=0)
+    # 额外用精排模型给全部文档打分，计算级联结果相对全量精排的召回率（开销与不级联相同，仅用于评估）
+    recall_check: Optional[bool] = False
+
+
+class QADocs(BaseModel):
+    model: Optional[str] = None
+    query: Optional[str]
+    documents: Optional[List[str]]
+    # 只返回分数最高的 top_n 条 / 分数不低于 min_score 的结果，return_documents 时附带原文
+    top_n: Optional[int] = Field(default=None, ge=0)
+    min_score: Optional[float] = None
+    return_documents: Optional[bool] = False
+    # 长文档滑动窗口：按 token 切成有重叠的窗口分别打分，再按 max/mean 聚合为文档分数
+    sliding_window: Optional[bool] = False
+    window_size: Optional[int] = Field(default=None, gt=0)
+    window_overlap: Optional[int] = Field(default=64, ge=0)
+    aggregate: Optional[str] = "max"
+    cascade: Optional[CascadeConfig] = None
+    # 文档很多时先用 BM25 在提交的文档内做词法粗筛，只保留前 bm25_top_n 篇进入模型打分
+    bm25_top_n: Optional[int] = Field(default=None, gt=0)
+
+    @validator("window_overlap", always=True)
+    def check_window_overlap(cls, v, values):
+        window_size = values.get("window_size")
+        if v is not None and window_size is not None and v >= window_size:
+            raise ValueError("window_overlap must be smaller than window_size")
+        return v
+
+    @validator("aggregate")
+    def check_aggregate(cls, v):
+        if v not in ("max", "mean"):
+            raise ValueError("aggregate must be max or mean")
+        return v
+
+
+class BatchQADocs(BaseModel):
+    model: Optional[str] = None
+    # 每项与 /v1/rerank 的请求体相同，项内的 model 字段不生效，不支持 cascade
+    queries: List[QADocs]
+
+    @validator("queries")
+    def check_queries(cls, v):
+        if any(query_docs.cascade is not None for query_docs in v):
+            raise ValueError("cascade is not supported in /v1/rerank/batch")
+        return v
+
+
+# GPU显存回收
+def torch_gc():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+
+# 可用模型：名称 -> 模型目录，默认是与 app.py 同级的三个 bge 模型目录中实际存在的那些
+RERANK_MODELS = json.loads(os.getenv("RERANK_MODELS", "null")) or {
+    name: os.path.join(os.path.dirname(__file__), name)
+    for name in ("bge-reranker-base", "bge-reranker-large", "bge-reranker-v2-m3")
+    if os.path.isdir(os.path.join(os.path.dirname(__file__), name))
+}
+DEFAULT_RERANK_MODEL = os.getenv("DEFAULT_RERANK_MODEL", next(iter(RERANK_MODELS), ""))
+# 常驻模型的内存/显存预算（MB），超出时淘汰最久未使用的空闲模型，0 表示不限制
+RERANK_MEMORY_BUDGET_MB = float(os.getenv("RERANK_MEMORY_BUDGET_MB", 0))
+# 跨请求合并批次：单批最多的 (query, doc) 对数，以及凑批的最长等待时间
+RERANK_MAX_BATCH_SIZE = int(os.getenv("RERANK_MAX_BATCH_SIZE", 256))
+RERANK_BATCH_WAIT_MS = float(os.getenv("RERANK_BATCH_WAIT_MS", 5))
+# 单次前向：最大 token 长度、最多的 pair 数，以及一次前向的 token 预算（pair 数 × 补齐后长度）
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", 512))
+RERANK_FORWARD_BATCH_SIZE = int(os.getenv("RERANK_FORWARD_BATCH_SIZE", 256))
+RERANK_BATCH_TOKENS = int(os.getenv("RERANK_BATCH_TOKENS", 32768))
+# 推理后端：torch（FlagReranker）或 onnx（onnxruntime，CPU），onnx 可选动态 int8 量化及线程数
+RERANK_BACKEND = os.getenv("RERANK_BACKEND", "torch")
+RERANK_ONNX_QUANTIZE = os.getenv("RERANK_ONNX_QUANTIZE", "0") == "1"
+RERANK_ONNX_INTRA_THREADS = int(os.getenv("RERANK_ONNX_INTRA_THREADS", 0))
+RERANK_ONNX_INTER_THREADS = int(os.getenv("RERANK_ONNX_INTER_THREADS", 0))
+# 推理线程池大小，以及线程全忙时最多排队的请求数，超出后直接返回 429
+RERANK_WORKERS = int(os.getenv("RERANK_WORKERS", 16))
+RERANK_MAX_QUEUE = int(os.getenv("RERANK_MAX_QUEUE", 128))
+# 分数缓存：最多缓存的 (query, doc) 对数（0 表示关闭）以及过期时间（秒）
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", 200000))
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", 3600))
+# 文档 token id 缓存（每个模型一份）最多缓存的文档数，0 表示关闭
+RERANK_TOKEN_CACHE_SIZE = int(os.getenv("RERANK_TOKEN_CACHE_SIZE", 50000))
+
+
+class BatchScheduler(object):
+    """把并发请求的 (query, doc) 对合并成一次模型调用，再把分数按请求拆回去。
+
+    调用方在任意线程里调用 compute_score 并阻塞等待结果；调度线程在
+    max_wait_ms 时间窗口内或凑满 max_batch_size 对后发起一次打分。
+    单个请求不会被拆分，超过 max_batch_size 的请求单独成批。
+    """
+
+    def __init__(self, predict, max_batch_size: int = RERANK_MAX_BATCH_SIZE,
+                 max_wait_ms: float = RERANK_BATCH_WAIT_MS):
+        self.predict = predict
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue = queue.Queue()
+        self._carry = None
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._batches = 0
+        self._pairs = 0
+        self._max_batch = 0
+        self._wait_total = 0.0
+        self._recent = deque(maxlen=1024)
+        self._thread = threading.Thread(target=self._loop, name="rerank-batcher", daemon=True)
+        self._thread.start()
+
+    def compute_score(self, pairs: List[List[str]]) -> List[float]:
+        future = Future()
+        self._queue.put((pairs, future, time.perf_counter()))
+        return future.result()
+
+    def _next(self, timeout: float):
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        if timeout is None:
+            return self._queue.get()
+        if timeout <= 0:
+            return self._queue.get_nowait()
+        return self._queue.get(timeout=timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            first = self._next(None)
+            if first is None:
+                return
+            batch = [first]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            closing = False
+            while size < self.max_batch_size:
+                try:
+                    item = self._next(deadline - time.perf_counter())
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                if size + len(item[0]) > self.max_batch_size:
+                    self._carry = item
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self._run_batch(batch)
+            if closing:
+                return
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        pairs = [pair for item in batch for pair in item[0]]
+        try:
+            scores = self.predict(pairs)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        offset = 0
+        for item_pairs, future, _ in batch:
+            future.set_result(scores[offset:offset + len(item_pairs)])
+            offset += len(item_pairs)
+        with self._lock:
+            self._requests += len(batch)
+            self._batches += 1
+            self._pairs += len(pairs)
+            self._max_batch = max(self._max_batch, len(pairs))
+            self._wait_total += sum(started - enqueued for _, _, enqueued in batch)
+            self._recent.append(len(pairs))
+
+    def stats(self) -> dict:
+        with self._lock:
+            recent = np.array(self._recent) if self._recent else np.zeros(1)
+            return {
+                "queue_depth": self._queue.qsize() + (self._carry is not None),
+                "requests": self._requests,
+                "batches": self._batches,
+                "pairs": self._pairs,
+                "avg_batch_size": self._pairs / self._batches if self._batches else 0,
+                "max_batch_size": self._max_batch,
+                "p50_batch_size": float(np.percentile(recent, 50)),
+                "p95_batch_size": float(np.percentile(recent, 95)),
+                "avg_queue_wait_ms": self._wait_total / self._requests * 1000 if self._requests else 0,
+                "config": {"max_batch_size": self.max_batch_size, "max_wait_ms": self.max_wait * 1000},
+            }
+
+
+class InferencePool(object):
+    """在独立线程池中执行推理，并限制同时在途（执行中 + 排队）的请求数。
+
+    队列已满时立即以 429 拒绝，Retry-After 按平均耗时和当前积压估算。
+    """
+
+    def __init__(self, workers: int = RERANK_WORKERS, max_queue: int = RERANK_MAX_QUEUE):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rerank-worker")
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._rejected = 0
+        self._avg_latency = 0.0
+
+    def _admit(self) -> bool:
+        with self._lock:
+            if self._inflight >= self.workers + self.max_queue:
+                self._rejected += 1
+                return False
+            self._inflight += 1
+            return True
+
+    def retry_after(self) -> int:
+        with self._lock:
+            backlog = self._inflight / self.workers
+            return max(1, math.ceil(self._avg_latency * backlog))
+
+    async def run(self, fn, *args):
+        if not self._admit():
+            raise HTTPException(status_code=429, detail="Too many requests, rerank queue is full",
+                                headers={"Retry-After": str(self.retry_after())})
+        started = time.perf_counter()
+
+        def done(_):
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._inflight -= 1
+                self._avg_latency = elapsed if self._avg_latency == 0 else 0.9 * self._avg_latency + 0.1 * elapsed
+
+        # 在线程任务真正结束（或排队时被取消）后才释放名额，客户端断开不会让在途数少算
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "inflight": self._inflight,
+                "waiting": max(0, self._inflight - self.workers),
+                "rejected": self._rejected,
+                "avg_latency_ms": self._avg_latency * 1000,
+                "config": {"workers": self.workers, "max_queue": self.max_queue},
+            }
+
+
+inference_pool = InferencePool()
+
+
+class ScoreCache(object):
+    """(query, doc) 分数的 LRU + TTL 缓存。
+
+    键为模型名、query、doc 拼接后的 sha256 摘要，值只存分数和写入时间，
+    每条约 200 字节，容量由 max_entries 限定。
+    """
+
+    def __init__(self, max_entries: int = RERANK_CACHE_SIZE, ttl: float = RERANK_CACHE_TTL):
+        self.max_entries = max(0, max_entries)
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def make_key(model_name: str, query: str, doc: str) -> bytes:
+        h = hashlib.sha256()
+        for part in (model_name, query, doc):
+            data = part.encode("utf-8")
+            h.update(len(data).to_bytes(8, "little"))
+            h.update(data)
+        return h.digest()
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[float]]:
+        if self.max_entries == 0:
+            return [None] * len(keys)
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is not None and self.ttl > 0 and now - entry[1] > self.ttl:
+                    del self._data[key]
+                    self._evictions += 1
+                    entry = None
+                if entry is None:
+                    self._misses += 1
+                    values.append(None)
+                else:
+                    self._data.move_to_end(key)
+                    self._hits += 1
+                    values.append(entry[0])
+        return values
+
+    def put_many(self, keys: List[bytes], values: List[float]):
+        if self.max_entries == 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._data[key] = (value, now)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "size": len(self._data),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / total if total else 0,
+                "evictions": self._evictions,
+                "config": {"max_entries": self.max_entries, "ttl": self.ttl},
+            }
+
+
+score_cache = ScoreCache()
+
+
+class TokenCache(ScoreCache):
+    """按文档内容哈希缓存文档的 token id（不含特殊 token），知识库 chunk 只需分词一次。"""
+
+    def __init__(self, max_entries: int = RERANK_TOKEN_CACHE_SIZE):
+        super().__init__(max_entries, ttl=0)
+
+    @staticmethod
+    def make_key(doc: str) -> bytes:
+        return hashlib.blake2b(doc.encode("utf-8"), digest_size=16).digest()
+
+
+class TorchBackend(object):
+    def __init__(self, model_path: str):
+        self.reranker = FlagReranker(model_path, use_fp16=False)
+        self.tokenizer = self.reranker.tokenizer
+
+    @torch.no_grad()
+    def forward(self, inputs: dict) -> np.ndarray:
+        tensors = {key: torch.from_numpy(value).to(self.reranker.device) for key, value in inputs.items()}
+        return self.reranker.model(**tensors, return_dict=True).logits.view(-1, ).float().cpu().numpy()
+
+
+class OnnxBackend(object):
+    """onnxruntime CPU 推理。首次使用时把模型导出到 <model_path>/onnx/，可选动态 int8 量化。"""
+
+    def __init__(self, model_path: str, quantize: bool = RERANK_ONNX_QUANTIZE,
+                 intra_threads: int = RERANK_ONNX_INTRA_THREADS, inter_threads: int = RERANK_ONNX_INTER_THREADS):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_threads
+        options.inter_op_num_threads = inter_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.onnx_path = OnnxBackend.export(model_path, self.tokenizer, quantize)
+        self.session = ort.InferenceSession(self.onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {item.name for item in self.session.get_inputs()}
+
+    @staticmethod
+    def export(model_path: str, tokenizer, quantize: bool) -> str:
+        onnx_dir = os.path.join(model_path, "onnx")
+        fp32_path = os.path.join(onnx_dir, "model.onnx")
+        int8_path = os.path.join(onnx_dir, "model.int8.onnx")
+        if not os.path.exists(fp32_path):
+            from transformers import AutoModelForSequenceClassification
+
+            # 先导出到临时目录再改名，导出中断时不会留下半个模型
+            tmp_dir = onnx_dir + ".tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            model = AutoModelForSequenceClassification.from_pretrained(model_path).eval()
+            dummy = dict(tokenizer([["query", "document"]], return_tensors="pt"))
+            names = list(dummy)
+            dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+            dynamic_axes["logits"] = {0: "batch"}
+            # 新版 torch 默认使用 dynamo 导出器，这里固定使用 TorchScript 导出器，结果可被 quantize_dynamic 处理
+            options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+            with torch.no_grad():
+                torch.onnx.export(model, (dummy,), os.path.join(tmp_dir, "model.onnx"), input_names=names,
+                                  output_names=["logits"], dynamic_axes=dynamic_axes, opset_version=14,
+                                  do_constant_folding=True, **options)
+            shutil.rmtree(onnx_dir, ignore_errors=True)
+            os.replace(tmp_dir, onnx_dir)
+            logging.info(f"Exported {model_path} to {fp32_path}")
+        if not quantize:
+            return fp32_path
+        if not os.path.exists(int8_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(fp32_path, int8_path + ".tmp", weight_type=QuantType.QInt8)
+            os.replace(int8_path + ".tmp", int8_path)
+            logging.info(f"Quantized {fp32_path} to {int8_path}")
+        return int8_path
+
+    def forward(self, inputs: dict) -> np.ndarray:
+        feed = {key: value for key, value in inputs.items() if key in self.input_names}
+        return self.session.run(["logits"], feed)[0].reshape(-1).astype(np.float32)
+
+
+class ReRanker(object):
+    def __init__(self, model_path, cache: ScoreCache = score_cache, backend: str = RERANK_BACKEND,
+                 quantize: bool = RERANK_ONNX_QUANTIZE):
+        self.model_name = os.path.basename(os.path.normpath(model_path))
+        self.memory_bytes = ReRanker.estimate_memory(model_path)
+        self.backend = OnnxBackend(model_path, quantize) if backend == "onnx" else TorchBackend(model_path)
+        self.tokenizer = self.backend.tokenizer
+        # fast tokenizer 不能并发调用（截断设置会在调用间切换），所有分词都经过 tokenize 串行执行
+        self._tokenizer_lock = threading.Lock()
+        self.token_cache = TokenCache()
+        self._init_template()
+        self.scheduler = BatchScheduler(self._predict)
+        self.cache = cache
+
+    def _init_template(self):
+        # 用占位 id 推出 pair 的拼接模板：prefix + query + middle + doc + suffix，
+        # 以及两段各自的 token_type_id，之后直接用缓存的 id 拼接输入
+        template = self.tokenizer.build_inputs_with_special_tokens([-1], [-2])
+        types = self.tokenizer.create_token_type_ids_from_sequences([-1], [-2])
+        q_pos, d_pos = template.index(-1), template.index(-2)
+        self.prefix = np.array(template[:q_pos], dtype=np.int64)
+        self.middle = np.array(template[q_pos + 1:d_pos], dtype=np.int64)
+        self.suffix = np.array(template[d_pos + 1:], dtype=np.int64)
+        self.segment_types = (types[q_pos], types[d_pos])
+        self.with_token_types = "token_type_ids" in self.tokenizer.model_input_names
+        self.pair_budget = RERANK_MAX_LENGTH - len(template) + 2
+
+    @staticmethod
+    def estimate_memory(model_path: str) -> int:
+        # 以权重文件大小估算加载后的占用，加载前即可判断是否需要淘汰
+        total = 0
+        for name in os.listdir(model_path):
+            if name.endswith((".bin", ".safetensors", ".pt")):
+                total += os.path.getsize(os.path.join(model_path, name))
+        return total
+
+    def close(self):
+        self.scheduler.close()
+        del self.backend
+
+    @staticmethod
+    def length_buckets(lengths: np.ndarray, max_batch_size: int = RERANK_FORWARD_BATCH_SIZE,
+                       max_batch_tokens: int = RERANK_BATCH_TOKENS) -> List[np.ndarray]:
+        # 按长度升序切分批次：批内补齐长度等于最后一条的长度，
+        # 在 token 预算内尽量多放，短文本批次大、长文本批次小
+        order = np.argsort(lengths, kind="stable")
+        buckets, start = [], 0
+        for end in range(1, len(order) + 1):
+            if end < len(order):
+                count = end + 1 - start
+                if count <= max_batch_size and count * lengths[order[end]] <= max_batch_tokens:
+                    continue
+            buckets.append(order[start:end])
+            start = end
+        return buckets
+
+    def _truncate(self, query_length: int, doc_length: int) -> Tuple[int, int]:
+        # 与 tokenizer 的 longest_first 截断结果一致：较短的一段最多保留一半预算
+        budget = self.pair_budget
+        if query_length + doc_length <= budget:
+            return query_length, doc_length
+        if min(query_length, doc_length) * 2 <= budget:
+            if query_length <= doc_length:
+                return query_length, budget - query_length
+            return budget - doc_length, doc_length
+        half = budget // 2
+        return (budget - half, half) if query_length > doc_length else (half, budget - half)
+
+    def tokenize(self, texts, **kwargs) -> dict:
+        with self._tokenizer_lock:
+            return self.tokenizer(texts, add_special_tokens=False, verbose=False, **kwargs)
+
+    def encode_pairs(self, pairs: List[List[str]]) -> Tuple[List[np.ndarray], np.ndarray]:
+        # 每个 query 只分词一次，文档 token id 按内容哈希从缓存取，未命中的一次性分词后写回；
+        # 返回每个 pair 的 input_ids 以及第一段（prefix + query + middle）的长度
+        queries = list(dict.fromkeys(query for query, _ in pairs))
+        encoded = self.tokenize(queries)["input_ids"]
+        query_ids = {query: np.array(ids, dtype=np.int64) for query, ids in zip(queries, encoded)}
+        keys = [TokenCache.make_key(doc) for _, doc in pairs]
+        doc_ids = self.token_cache.get_many(keys)
+        missing = {}
+        for i, ids in enumerate(doc_ids):
+            if ids is None:
+                missing.setdefault(keys[i], pairs[i][1])
+        if missing:
+            encoded = self.tokenize(list(missing.values()), truncation=True,
+                                    max_length=self.pair_budget)["input_ids"]
+            fresh = dict(zip(missing, (np.array(ids, dtype=np.int64) for ids in encoded)))
+            self.token_cache.put_many(list(fresh), list(fresh.values()))
+            doc_ids = [ids if ids is not None else fresh[key] for ids, key in zip(doc_ids, keys)]
+        input_ids, first_lengths = [], np.empty(len(pairs), dtype=np.int64)
+        for i, (query, _) in enumerate(pairs):
+            q, d = query_ids[query], doc_ids[i]
+            q_len, d_len = self._truncate(len(q), len(d))
+            input_ids.append(np.concatenate((self.prefix, q[:q_len], self.middle, d[:d_len], self.suffix)))
+            first_lengths[i] = len(self.prefix) + q_len + len(self.middle)
+        return input_ids, first_lengths
+
+    def _predict(self, pairs: List[List[str]], buckets: Optional[List[np.ndarray]] = None) -> List[float]:
+        # 由缓存的 token id 直接拼出输入，按长度分桶后逐桶补齐前向，分数写回原始位置
+        input_ids, first_lengths = self.encode_pairs(pairs)
+        lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(pairs))
+        logits = np.empty(len(pairs), dtype=np.float32)
+        for bucket in buckets if buckets is not None else self.length_buckets(lengths):
+            inputs = self._collate(input_ids, first_lengths, lengths, bucket)
+            logits[bucket] = self.backend.forward(inputs)
+        return (1 / (1 + np.exp(-logits))).tolist()
+
+    def _collate(self, input_ids: List[np.ndarray], first_lengths: np.ndarray, lengths: np.ndarray,
+                 bucket: np.ndarray) -> dict:
+        width = int(lengths[bucket].max())
+        ids = np.full((len(bucket), width), self.tokenizer.pad_token_id, dtype=np.int64)
+        for row, i in enumerate(bucket):
+            ids[row, :lengths[i]] = input_ids[i]
+        positions = np.arange(width)
+        attention_mask = (positions < lengths[bucket][:, None]).astype(np.int64)
+        inputs = {"input_ids": ids, "attention_mask": attention_mask}
+        if self.with_token_types:
+            first, second = self.segment_types
+            token_types = np.where(positions < first_lengths[bucket][:, None], first, second)
+            inputs["token_type_ids"] = (token_types * attention_mask).astype(np.int64)
+        return inputs
+
+    def split_windows(self, query: str, documents: List[str], window_size: Optional[int] = None,
+                      overlap: int = 64) -> Tuple[List[str], np.ndarray]:
+        # 按 token 偏移切出原文片段，每个窗口加上 query 后不超过 RERANK_MAX_LENGTH；
+        # 返回所有窗口文本以及每篇文档的窗口数
+        query_length = len(self.tokenize(query)["input_ids"])
+        budget = RERANK_MAX_LENGTH - query_length - self.tokenizer.num_special_tokens_to_add(pair=True)
+        window = max(16, min(window_size or budget, budget))
+        # 重叠最多半个窗口，query 很长、预算被压到下限时步长也不会退化成 1
+        stride = window - min(overlap or 0, window // 2)
+        offsets = self.tokenize(documents, return_offsets_mapping=True)["offset_mapping"]
+        windows, counts = [], np.zeros(len(documents), dtype=np.int64)
+        for i, (doc, doc_offsets) in enumerate(zip(documents, offsets)):
+            if len(doc_offsets) <= window:
+                windows.append(doc)
+                counts[i] = 1
+                continue
+            for start in range(0, len(doc_offsets), stride):
+                end = min(start + window, len(doc_offsets))
+                windows.append(doc[doc_offsets[start][0]:doc_offsets[end - 1][1]])
+                counts[i] += 1
+                if end == len(doc_offsets):
+                    break
+        return windows, counts
+
+    def compute_score(self, pairs: List[List[str]]):
+        if len(pairs) > 0:
+            keys = [ScoreCache.make_key(self.model_name, query, doc) for query, doc in pairs]
+            scores = self.cache.get_many(keys)
+            missing = [i for i, score in enumerate(scores) if score is None]
+            # 全部命中时不经过调度器，也不调用模型
+            if len(missing) > 0:
+                computed = self.scheduler.compute_score([pairs[i] for i in missing])
+                self.cache.put_many([keys[i] for i in missing], computed)
+                for i, score in zip(missing, computed):
+                    scores[i] = score
+            return scores
+        else:
+            return None
+
+class ModelRegistry(object):
+    """按请求的 model 字段懒加载 ReRanker，多个模型共用一个进程。
+
+    每个模型第一次被请求时才加载；加载前按权重大小估算占用，超出
+    memory_budget_mb 时按最久未使用的顺序淘汰当前没有请求在用的模型。
+    """
+
+    def __init__(self, model_paths: dict = RERANK_MODELS, default_model: str = DEFAULT_RERANK_MODEL,
+                 memory_budget_mb: float = RERANK_MEMORY_BUDGET_MB):
+        # 配置错误在启动时报出，而不是每个请求都失败
+        if default_model not in model_paths:
+            raise ValueError(f"Default rerank model {default_model!r} is not in RERANK_MODELS {list(model_paths)}; "
+                             "download a model next to app.py or set RERANK_MODELS / DEFAULT_RERANK_MODEL")
+        self.model_paths = model_paths
+        self.default_model = default_model
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self._models = OrderedDict()
+        self._refs = {}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in model_paths}
+        self._loads = 0
+        self._evictions = 0
+
+    def resolve(self, name: Optional[str]) -> str:
+        # 兼容 FastGPT 中 "BAAI/bge-reranker-v2-m3" 这类带组织前缀的模型 ID，
+        # 未知名称回落到默认模型，与之前单模型服务的行为一致
+        if name in self.model_paths:
+            return name
+        if name is not None and name.split("/")[-1] in self.model_paths:
+            return name.split("/")[-1]
+        if name is not None:
+            logging.warning(f"Unknown rerank model {name}, fallback to {self.default_model}")
+        return self.default_model
+
+    @contextmanager
+    def use(self, name: Optional[str] = None):
+        name = self.resolve(name)
+        reranker = self._acquire(name)
+        try:
+            yield reranker
+        finally:
+            with self._lock:
+                self._refs[name] -= 1
+
+    def _acquire(self, name: str) -> ReRanker:
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    self._refs[name] += 1
+                    return self._models[name]
+            model_path = self.model_paths[name]
+            self._evict_for(ReRanker.estimate_memory(model_path))
+            reranker = ReRanker(model_path)
+            with self._lock:
+                self._models[name] = reranker
+                self._refs[name] = 1
+                self._loads += 1
+            return reranker
+
+    def _evict_for(self, size: int):
+        if self.memory_budget <= 0:
+            return
+        evicted = []
+        with self._lock:
+            resident = sum(reranker.memory_bytes for reranker in self._models.values())
+            for name in list(self._models):
+                if resident + size <= self.memory_budget:
+                    break
+                if self._refs[name] > 0:
+                    continue
+                reranker = self._models.pop(name)
+                del self._refs[name]
+                resident -= reranker.memory_bytes
+                evicted.append(reranker)
+                self._evictions += 1
+            if resident + size > self.memory_budget:
+                logging.warning(f"Rerank memory budget exceeded, {resident + size} > {self.memory_budget} bytes")
+        for reranker in evicted:
+            logging.info(f"Evict rerank model {reranker.model_name}")
+            reranker.close()
+        if evicted:
+            gc.collect()
+            torch_gc()
+
+    def loaded(self) -> dict:
+        with self._lock:
+            return dict(self._models)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "models": list(self.model_paths),
+                "default_model": self.default_model,
+                "loaded": {name: {"memory_mb": reranker.memory_bytes / 1024 / 1024, "in_use": self._refs[name]}
+                           for name, reranker in self._models.items()},
+                "loads": self._loads,
+                "evictions": self._evictions,
+                "config": {"memory_budget_mb": self.memory_budget / 1024 / 1024},
+            }
+
+
+model_registry = ModelRegistry()
+
+
+class BM25(object):
+    """在单次请求提交的文档内计算 BM25，只统计 query 中出现的词，词频矩阵用 numpy 计算。
+
+    分词：英文/数字按单词切分并转小写，中日韩文字按单字 + 相邻双字切分。
+    """
+
+    CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+    WORD_PATTERN = re.compile(r"[0-9a-z]+")
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        text = text.lower()
+        tokens = BM25.WORD_PATTERN.findall(text)
+        for run in BM25.CJK_PATTERN.findall(text):
+            tokens.extend(run)
+            tokens.extend(map(operator.add, run, run[1:]))
+        return tokens
+
+    def score(self, query: str, documents: List[str]) -> np.ndarray:
+        query_terms, query_counts = np.unique(np.array(self.tokenize(query), dtype=object), return_counts=True)
+        if len(query_terms) == 0 or len(documents) == 0:
+            return np.zeros(len(documents))
+        tf = np.zeros((len(documents), len(query_terms)), dtype=np.float64)
+        lengths = np.empty(len(documents), dtype=np.float64)
+        for d, doc in enumerate(documents):
+            counts = Counter(self.tokenize(doc))
+            lengths[d] = sum(counts.values())
+            tf[d] = [counts.get(term, 0) for term in query_terms]
+        df = np.count_nonzero(tf, axis=0)
+        idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1.0))
+        return (tf * (self.k1 + 1) / (tf + norm[:, None]) * (idf * query_counts)).sum(axis=1)
+
+    def top_n(self, query: str, documents: List[str], n: int) -> np.ndarray:
+        # 返回得分最高的 n 篇文档下标（按原始顺序），同分时保留靠前的文档
+        if n >= len(documents):
+            return np.arange(len(documents))
+        scores = self.score(query, documents)
+        order = np.argsort(-scores, kind="stable")[:n]
+        return np.sort(order)
+
+
+class Chat(object):
+    def __init__(self, registry: ModelRegistry = model_registry):
+        self.registry = registry
+
+    def fit_query_answer_rerank(self, query_docs: QADocs) -> List:
+        if query_docs is None or len(query_docs.documents) == 0:
+            return []
+
+        candidates, documents = self.lexical_candidates(query_docs)
+        with self.registry.use(query_docs.model) as reranker:
+            scores = self.score_documents(reranker, query_docs, documents)
+        return self.format_results(query_docs, scores, candidates)
+
+    @staticmethod
+    def lexical_candidates(query_docs: QADocs) -> Tuple[Optional[np.ndarray], List[str]]:
+        # 返回 BM25 粗筛后保留的文档下标（未启用或无需筛选时为 None）以及对应的文档
+        documents = query_docs.documents
+        if query_docs.bm25_top_n is None or len(documents) <= query_docs.bm25_top_n:
+            return None, documents
+        candidates = BM25().top_n(query_docs.query, documents, query_docs.bm25_top_n)
+        return candidates, [documents[i] for i in candidates]
+
+    def fit_cascade_rerank(self, query_docs: QADocs) -> dict:
+        config = query_docs.cascade
+        diagnostics = {"prefilter_model": self.registry.resolve(config.prefilter_model),
+                       "model": self.registry.resolve(query_docs.model)}
+        if not query_docs.documents:
+            return {"results": [], "cascade": dict(diagnostics, candidates=0)}
+
+        started = time.perf_counter()
+        candidates, documents = self.lexical_candidates(query_docs)
+        if candidates is None:
+            candidates = np.arange(len(documents))
+        diagnostics["candidates"] = len(documents)
+        with self.registry.use(config.prefilter_model) as reranker:
+            prefilter_scores = self.score_documents(reranker, query_docs, documents)
+        prefilter_done = time.perf_counter()
+        survivors = self.select_survivors(prefilter_scores, config.top_k, config.margin)
+        with self.registry.use(query_docs.model) as reranker:
+            scores = self.score_documents(reranker, query_docs, [documents[i] for i in survivors])
+        finished = time.perf_counter()
+        results = self.format_results(query_docs, scores, candidates[survivors])
+
+        # 返回结果在小模型排序中的名次，名次越靠后说明 top_k 越接近不够用
+        prefilter_rank = np.full(len(query_docs.documents), -1, dtype=np.int64)
+        prefilter_rank[candidates[np.argsort(-prefilter_scores, kind="stable")]] = np.arange(len(documents))
+        result_ranks = [int(prefilter_rank[item["index"]]) for item in results]
+        diagnostics.update({
+            "survivors": len(survivors),
+            "survivor_min_prefilter_score": float(prefilter_scores[survivors].min()),
+            "result_prefilter_ranks": result_ranks,
+            "max_result_prefilter_rank": max(result_ranks) if result_ranks else None,
+            "timings_ms": {"prefilter": (prefilter_done - started) * 1000,
+                           "rerank": (finished - prefilter_done) * 1000,
+                           "total": (finished - started) * 1000},
+        })
+        if config.recall_check:
+            with self.registry.use(query_docs.model) as reranker:
+                full_scores = self.score_documents(reranker, query_docs, documents)
+            expected = candidates[self.select_top(full_scores, query_docs.top_n or len(survivors), query_docs.min_score)]
+            found = {item["index"] for item in results}
+            diagnostics["recall"] = len(found.intersection(expected.tolist())) / len(expected) if len(expected) else 1.0
+        return {"results": results, "cascade": diagnostics}
+
+    @staticmethod
+    def select_survivors(scores: np.ndarray, top_k: int, margin: float = 0) -> np.ndarray:
+        # 保留分数不低于第 top_k 名减 margin 的文档，按原始顺序返回
+        if top_k >= len(scores):
+            return np.arange(len(scores))
+        kth = -np.partition(-scores, top_k - 1)[top_k - 1]
+        return np.flatnonzero(scores >= kth - (margin or 0))
+
+    def fit_batch_rerank(self, batch: BatchQADocs) -> List[List]:
+        # 所有 query 的 pair 展平后一次提交打分，再按 query 拆分、各自排序
+        items = [query_docs for query_docs in batch.queries if query_docs.documents]
+        if len(items) == 0:
+            return [[] for _ in batch.queries]
+        filtered = [self.lexical_candidates(query_docs) for query_docs in items]
+        with self.registry.use(batch.model) as reranker:
+            built = [self.build_pairs(reranker, query_docs, documents)
+                     for query_docs, (_, documents) in zip(items, filtered)]
+            scores = np.asarray(reranker.compute_score([pair for pairs, _ in built for pair in pairs]), dtype=np.float64)
+        splits = np.cumsum([len(pairs) for pairs, _ in built])[:-1]
+        results = iter([
+            self.format_results(query_docs, self.aggregate(part, counts, query_docs.aggregate), candidates)
+            for query_docs, (_, counts), part, (candidates, _) in zip(items, built, np.split(scores, splits), filtered)
+        ])
+        return [next(results) if query_docs.documents else [] for query_docs in batch.queries]
+
+    @staticmethod
+    def build_pairs(reranker: ReRanker, query_docs: QADocs, documents: List[str]) -> Tuple[List[List[str]], Optional[np.ndarray]]:
+        # 滑动窗口模式下返回所有窗口的 pair 以及每篇文档的窗口数
+        if not query_docs.sliding_window:
+            return [[query_docs.query, doc] for doc in documents], None
+        windows, counts = reranker.split_windows(query_docs.query, documents, query_docs.window_size,
+                                                 query_docs.window_overlap)
+        return [[query_docs.query, w] for w in windows], counts
+
+    @staticmethod
+    def aggregate(scores: np.ndarray, counts: Optional[np.ndarray], how: str = "max") -> np.ndarray:
+        if counts is None:
+            return scores
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        if how == "mean":
+            return np.add.reduceat(scores, starts) / counts
+        return np.maximum.reduceat(scores, starts)
+
+    @staticmethod
+    def score_documents(reranker: ReRanker, query_docs: QADocs, documents: List[str]) -> np.ndarray:
+        # 所有文档（滑动窗口模式下为所有窗口）一次提交打分，再按文档聚合
+        pairs, counts = Chat.build_pairs(reranker, query_docs, documents)
+        scores = np.asarray(reranker.compute_score(pairs), dtype=np.float64)
+        return Chat.aggregate(scores, counts, query_docs.aggregate)
+
+    @staticmethod
+    def select_top(scores: np.ndarray, top_n: Optional[int] = None, min_score: Optional[float] = None) -> np.ndarray:
+        # 先按阈值过滤，再用 argpartition 取 top_n，只对选中的部分排序
+        indices = np.arange(len(scores))
+        if min_score is not None:
+            indices = indices[scores >= min_score]
+        if top_n is not None and top_n < len(indices):
+            if top_n == 0:
+                return indices[:0]
+            part = np.argpartition(-scores[indices], top_n - 1)[:top_n]
+            indices = indices[part]
+        return indices[np.argsort(-scores[indices], kind="stable")]
+
+    @staticmethod
+    def format_results(query_docs: QADocs, scores: List[float], candidates: Optional[np.ndarray] = None) -> List:
+        # candidates 不为空时，scores 对应 documents[candidates]，返回的 index 仍是原始文档下标
+        scores = np.asarray(scores, dtype=np.float64)
+        indices = Chat.select_top(scores, query_docs.top_n, query_docs.min_score)
+        doc_indices = indices if candidates is None else candidates[indices]
+        if query_docs.return_documents:
+            return [{"index": int(d), "relevance_score": float(scores[i]), "document": {"text": query_docs.documents[d]}} for i, d in zip(indices, doc_indices)]
+        return [{"index": int(d), "relevance_score": float(scores[i])} for i, d in zip(indices, doc_indices)]
+
+
+def rerank(docs: QADocs) -> dict:
+    if docs.cascade is not None:
+        return Chat().fit_cascade_rerank(docs)
+    return {"results": Chat().fit_query_answer_rerank(docs)}
+
+
+def rerank_batch(batch: BatchQADocs) -> List[List]:
+    return Chat().fit_batch_rerank(batch)
+
+@app.post('/v1/rerank')
+async def handle_post_request(docs: QADocs, credentials: HTTPAuthorizationCredentials = Security(security)):
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    try:
+        # 推理在独立线程池中执行，不阻塞事件循环，并发请求也能进入同一批
+        return await inference_pool.run(rerank, docs)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        print(f"报错：\n{e}")
+        return {"error": "重排出错"}
+
+@app.post('/v1/rerank/batch')
+async def handle_batch_request(batch: BatchQADocs, credentials: HTTPAuthorizationCredentials = Security(security)):
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    try:
+        results = await inference_pool.run(rerank_batch, batch)
+        return {"results": results}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        print(f"报错：\n{e}")
+        return {"error": "重排出错"}
+
+@app.get('/v1/rerank/stats')
+async def handle_stats_request(credentials: HTTPAuthorizationCredentials = Security(security)):
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return {
+        "pool": inference_pool.stats(),
+        "registry": model_registry.stats(),
+        "scheduler": {name: reranker.scheduler.stats() for name, reranker in model_registry.loaded().items()},
+        "cache": score_cache.stats(),
+        "token_cache": {name: reranker.token_cache.stats() for name, reranker in model_registry.loaded().items()},
+    }
+
+@app.get('/health')
+async def handle_health_request():
+    return {"status": "ok"}
+
+if __name__ == "__main__":
+    token = os.getenv("ACCESS_TOKEN")
+    if token is not None:
+        env_bearer_token = token
+    try:
+        uvicorn.run(app, host='0.0.0.0', port=6006)
+    except Exception as e:
+        print(f"API启动失败！\n报错：\n{e}")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File: bench_bucketing.py
+@Desc: 对比按请求顺序打分与按长度分桶打分的吞吐，文档长度混合分布
+
+用法：
+    python bench_bucketing.py --model bge-reranker-base --docs 512 --rounds 3
+"""
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+WORDS = ["检索", "知识库", "重排", "模型", "文档", "向量", "search", "rerank", "chunk", "query",
+         "FastGPT", "embedding", "token", "latency", "throughput", "数据集", "问答", "上下文"]
+
+
+def load_app(path: str):
+    path = os.path.abspath(path)
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location("rerank_app", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_pairs(n: int, short_ratio: float, seed: int):
+    # 大部分是短 chunk，混入少量接近截断长度的长 chunk
+    rng = random.Random(seed)
+    query = " ".join(rng.choice(WORDS) for _ in range(8))
+    pairs = []
+    for _ in range(n):
+        words = rng.randint(5, 40) if rng.random() < short_ratio else rng.randint(200, 400)
+        pairs.append([query, " ".join(rng.choice(WORDS) for _ in range(words))])
+    return pairs
+
+
+def timeit(fn, pairs, rounds: int):
+    fn(pairs)
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        scores = fn(pairs)
+        best = min(best, time.perf_counter() - start)
+    return best, np.asarray(scores, dtype=np.float64)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default=os.path.join(os.path.dirname(__file__), "app.py"))
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--backend", default=None, choices=["torch", "onnx"])
+    parser.add_argument("--docs", type=int, default=512)
+    parser.add_argument("--short-ratio", type=float, default=0.9)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = load_app(args.app)
+    reranker = app.ReRanker(app.RERANK_MODELS[args.model or app.DEFAULT_RERANK_MODEL],
+                            backend=args.backend or app.RERANK_BACKEND)
+    pairs = make_pairs(args.docs, args.short_ratio, args.seed)
+
+    def in_order(batch):
+        # 按请求顺序每 RERANK_FORWARD_BATCH_SIZE 条一批，批内补齐到最长的一条
+        size = app.RERANK_FORWARD_BATCH_SIZE
+        return reranker._predict(batch, [np.arange(i, min(i + size, len(batch))) for i in range(0, len(batch), size)])
+
+    base_time, base_scores = timeit(in_order, pairs, args.rounds)
+    bucket_time, bucket_scores = timeit(reranker._predict, pairs, args.rounds)
+    print(f"pairs: {len(pairs)}, short ratio: {args.short_ratio}")
+    print(f"request order: {base_time:.3f}s, {len(pairs) / base_time:.1f} pairs/s")
+    print(f"length bucket: {bucket_time:.3f}s, {len(pairs) / bucket_time:.1f} pairs/s")
+    print(f"speedup: {base_time / bucket_time:.2f}x, max score diff: {np.abs(base_scores - bucket_scores).max():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File: benchmark.py
+@Desc: 重排服务基准测试：生成指定文档数/长度的合成语料，分别在进程内调用 Chat.fit_query_answer_rerank
+       和通过 HTTP 调用 /v1/rerank，逐级提高并发，输出 p50/p95/p99 延迟、pairs/s 和峰值内存的 JSON 报告
+
+每个 (模型, 后端) 组合在独立子进程中运行，峰值内存互不影响。
+
+用法：
+    python benchmark.py --models bge-reranker-base --backends torch,onnx --docs 10,100 --doc-words 30,200
+    python benchmark.py --concurrency 1,4,16 --requests 64 --output report.json
+    python benchmark.py --url http://127.0.0.1:6006 --token mytoken   # 压测已启动的服务，只测 HTTP
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bench_bucketing import WORDS, load_app
+
+# 后端名 -> 子进程环境变量
+BACKENDS = {
+    "torch": {"RERANK_BACKEND": "torch"},
+    "onnx": {"RERANK_BACKEND": "onnx", "RERANK_ONNX_QUANTIZE": "0"},
+    "onnx-int8": {"RERANK_BACKEND": "onnx", "RERANK_ONNX_QUANTIZE": "1"},
+}
+
+
+def int_list(value: str):
+    return [int(v) for v in value.split(",") if v]
+
+
+def make_corpus(docs: int, doc_words: int, seed: int):
+    # 每篇文档的词数在 doc_words 上下浮动 20%，query 固定 8 个词
+    rng = random.Random(seed)
+    query = " ".join(rng.choice(WORDS) for _ in range(8))
+    documents = [" ".join(rng.choice(WORDS) for _ in range(max(1, int(doc_words * rng.uniform(0.8, 1.2)))))
+                 for _ in range(docs)]
+    return query, documents
+
+
+def peak_rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies, errors: int, pairs: int, elapsed: float) -> dict:
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    item = {"requests": len(latencies), "errors": errors, "elapsed_s": elapsed,
+            "requests_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "pairs_per_sec": pairs / elapsed if elapsed else 0.0}
+    for p in (50, 95, 99):
+        item[f"p{p}_ms"] = float(np.percentile(latencies, p)) if len(latencies) else None
+    return item
+
+
+def drive(call, corpora, concurrency: int, requests: int) -> dict:
+    # 以固定并发发出 requests 个请求，失败的请求不计入延迟
+    latencies, errors, pairs = [], 0, 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors, pairs
+        query, documents = corpora[i % len(corpora)]
+        start = time.perf_counter()
+        try:
+            call(query, documents)
+        except Exception as e:
+            with lock:
+                errors += 1
+            print(f"request failed: {e}", file=sys.stderr)
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+            pairs += len(documents)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    return summarize(latencies, errors, pairs, time.perf_counter() - started)
+
+
+def http_caller(url: str, token: str, model: str):
+    def call(query, documents):
+        body = json.dumps({"model": model, "query": query, "documents": documents}).encode("utf-8")
+        req = urllib.request.Request(url.rstrip("/") + "/v1/rerank", data=body, method="POST",
+                                     headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"})
+        with urllib.request.urlopen(req, timeout=600) as resp:
+            result = json.loads(resp.read())
+        if "results" not in result:
+            raise RuntimeError(result)
+        return result
+    return call
+
+
+def start_server(module):
+    # 在当前进程的后台线程中启动服务，峰值内存统计包含服务端
+    import uvicorn
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(module.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def run_levels(call, args, mode: str, model: str, backend: str) -> list:
+    results = []
+    for docs in args.docs:
+        for doc_words in args.doc_words:
+            corpora = [make_corpus(docs, doc_words, args.seed + i) for i in range(args.requests)]
+            call(*make_corpus(docs, doc_words, -1))  # 预热，包含模型懒加载
+            for concurrency in args.concurrency:
+                item = {"mode": mode, "model": model, "backend": backend, "docs": docs,
+                        "doc_words": doc_words, "concurrency": concurrency}
+                item.update(drive(call, corpora, concurrency, args.requests))
+                results.append(item)
+                print(f"{mode:9s} {model} {backend} docs={docs} words={doc_words} c={concurrency}: "
+                      f"p50={item['p50_ms']:.1f}ms p99={item['p99_ms']:.1f}ms {item['pairs_per_sec']:.1f} pairs/s",
+                      file=sys.stderr)
+    return results
+
+
+def worker(args):
+    # 子进程：加载一次 app，依次跑进程内和 HTTP 两种模式，结果以 JSON 输出到 stdout
+    module = load_app(args.app)
+    model = args.models[0]
+    results = []
+    if "inprocess" in args.modes:
+        chat = module.Chat()
+
+        def call(query, documents):
+            return chat.fit_query_answer_rerank(module.QADocs(model=model, query=query, documents=documents))
+
+        results += run_levels(call, args, "inprocess", model, args.backends[0])
+    if "http" in args.modes:
+        server, thread, url = start_server(module)
+        try:
+            results += run_levels(http_caller(url, module.env_bearer_token, model), args, "http", model,
+                                  args.backends[0])
+        finally:
+            server.should_exit = True
+            thread.join()
+    print(json.dumps({"model": model, "backend": args.backends[0], "peak_rss_mb": peak_rss_mb(),
+                      "results": results}, ensure_ascii=False))
+
+
+def spawn(args, model: str, backend: str) -> dict:
+    env = dict(os.environ, **BACKENDS[backend])
+    if not args.score_cache:
+        env["RERANK_CACHE_SIZE"] = "0"
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--app", args.app,
+           "--models", model, "--backends", backend, "--modes", ",".join(args.modes),
+           "--docs", ",".join(map(str, args.docs)), "--doc-words", ",".join(map(str, args.doc_words)),
+           "--concurrency", ",".join(map(str, args.concurrency)),
+           "--requests", str(args.requests), "--seed", str(args.seed)]
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        return {"model": model, "backend": backend, "error": f"worker exited with {proc.returncode}"}
+    return json.loads(proc.stdout.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"))
+    parser.add_argument("--models", default=None, help="逗号分隔，默认为 RERANK_MODELS 中的全部模型")
+    parser.add_argument("--backends", default="torch", help="逗号分隔，可选 " + ",".join(BACKENDS))
+    parser.add_argument("--modes", default="inprocess,http")
+    parser.add_argument("--docs", type=int_list, default=[10, 100], help="每个请求的文档数，逗号分隔")
+    parser.add_argument("--doc-words", type=int_list, default=[30, 200], help="每篇文档的平均词数，逗号分隔")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16], help="并发数，逗号分隔")
+    parser.add_argument("--requests", type=int, default=32, help="每个并发级别发出的请求数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--score-cache", action="store_true", help="保留分数缓存，默认关闭以测量模型本身")
+    parser.add_argument("--url", default=None, help="压测已启动的服务，只跑 HTTP 模式")
+    parser.add_argument("--token", default="ACCESS_TOKEN")
+    parser.add_argument("--output", default=None, help="报告输出路径，默认打印到 stdout")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.backends = [b for b in args.backends.split(",") if b]
+    args.modes = [m for m in args.modes.split(",") if m]
+
+    if args.worker:
+        args.models = [args.models]
+        return worker(args)
+
+    report = {"config": {k: getattr(args, k) for k in ("docs", "doc_words", "concurrency", "requests", "seed",
+                                                        "score_cache", "modes")},
+              "runs": []}
+    if args.url:
+        models = args.models.split(",") if args.models else [None]
+        for model in models:
+            results = run_levels(http_caller(args.url, args.token, model), args, "http", model, "remote")
+            report["runs"].append({"model": model, "backend": "remote", "peak_rss_mb": None, "results": results})
+    else:
+        models = args.models.split(",") if args.models else list(load_app(args.app).RERANK_MODELS)
+        for model in models:
+            for backend in args.backends:
+                report["runs"].append(spawn(args, model, backend))
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
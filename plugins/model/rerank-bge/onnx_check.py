@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File: onnx_check.py
+@Desc: 对比 torch 与 onnx（fp32 / int8）后端的分数误差、排序一致性和延迟
+
+用法：
+    python onnx_check.py --model bge-reranker-base --docs 100 --rounds 5
+    python onnx_check.py --samples samples.jsonl   # 每行 {"query": "...", "documents": ["...", ...]}
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from bench_bucketing import load_app, make_pairs
+
+
+def load_samples(path: str):
+    samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                samples.append([[item["query"], doc] for doc in item["documents"]])
+    return samples
+
+
+def rank_correlation(a: np.ndarray, b: np.ndarray) -> float:
+    # Spearman 相关系数（不处理并列）
+    ra = np.argsort(np.argsort(a)).astype(np.float64)
+    rb = np.argsort(np.argsort(b)).astype(np.float64)
+    if len(a) < 2:
+        return 1.0
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+
+def top_k_overlap(a: np.ndarray, b: np.ndarray, k: int) -> float:
+    k = min(k, len(a))
+    return len(set(np.argsort(-a)[:k]) & set(np.argsort(-b)[:k])) / k if k else 1.0
+
+
+def run(reranker, samples, rounds: int):
+    scores = [np.asarray(reranker._predict(pairs), dtype=np.float64) for pairs in samples]
+    latencies = []
+    for _ in range(rounds):
+        for pairs in samples:
+            start = time.perf_counter()
+            reranker._predict(pairs)
+            latencies.append(time.perf_counter() - start)
+    return scores, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default=os.path.join(os.path.dirname(__file__), "app.py"))
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--samples", default=None)
+    parser.add_argument("--queries", type=int, default=5)
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    app = load_app(args.app)
+    model_path = app.RERANK_MODELS[args.model or app.DEFAULT_RERANK_MODEL]
+    if args.samples:
+        samples = load_samples(args.samples)
+    else:
+        samples = [make_pairs(args.docs, 0.8, seed) for seed in range(args.queries)]
+
+    backends = {
+        "torch": ("torch", False),
+        "onnx-fp32": ("onnx", False),
+        "onnx-int8": ("onnx", True),
+    }
+    report = {}
+    reference = None
+    for name, (backend, quantize) in backends.items():
+        reranker = app.ReRanker(model_path, backend=backend, quantize=quantize)
+        scores, latencies = run(reranker, samples, args.rounds)
+        item = {
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "pairs_per_sec": float(sum(len(p) for p in samples) * args.rounds / latencies.sum() * 1000),
+        }
+        if reference is None:
+            reference = scores
+        else:
+            diffs = np.concatenate([np.abs(a - b) for a, b in zip(reference, scores)])
+            item.update({
+                "max_abs_diff": float(diffs.max()),
+                "mean_abs_diff": float(diffs.mean()),
+                "spearman": float(np.mean([rank_correlation(a, b) for a, b in zip(reference, scores)])),
+                f"top{args.top_k}_overlap": float(np.mean([top_k_overlap(a, b, args.top_k) for a, b in zip(reference, scores)])),
+            })
+        report[name] = item
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()